@@ -0,0 +1,191 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for analyse bills and transfers of a user in columnar
+form. Rows are loaded once into NumPy arrays, then every analysis (group by
+month or account, balances, period deltas, rolling averages) is vectorized
+instead of walking model instances. Amounts are integer cents, like in the
+database, so every sum is exact.
+"""
+import json
+import os
+import numpy as np
+
+from dbmodel import Bill, Transfer
+from dbdriver import stream, balance_sign
+from money import from_cents
+
+# date.toordinal() of 1970-01-01, to turn ordinals into datetime64[D]
+EPOCH_ORDINAL = 719163
+
+BILL_DTYPE = np.dtype([('amount', 'i8'), ('income', '?'),
+                       ('date', 'i8'), ('account', 'i8')])
+TRANSFER_DTYPE = np.dtype([('amount', 'i8'), ('date', 'i8'),
+                           ('from_account', 'i8'), ('to_account', 'i8')])
+
+def to_days(ordinals):
+    return (ordinals - EPOCH_ORDINAL).astype('M8[D]')
+
+def group_sum(keys, values):
+    """Sum values by keys. Return (sorted unique keys, sums)."""
+    uniques, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=values, minlength=len(uniques))
+    if np.issubdtype(values.dtype, np.integer):
+        # float64 holds integers exactly below 2**53 cents
+        sums = np.rint(sums).astype(values.dtype)
+    return uniques, sums
+
+def period_deltas(values):
+    """Change of every period against the previous one, first one against 0."""
+    return np.diff(values, prepend=0)
+
+def rolling_mean(values, window):
+    """Mean of the last window values at every position (shorter at the start)."""
+    sums = np.cumsum(values, dtype='f8')
+    sums[window:] = sums[window:] - sums[:-window]
+    counts = np.minimum(np.arange(1, len(values) + 1), window)
+    return sums / counts
+
+class Ledger():
+    """
+    Bills and transfers of one user as arrays. Bill amounts are signed:
+    income is positive and outcome negative. Dates are datetime64[D].
+    """
+    def __init__(self, bills, transfers, comments=None):
+        self.bill_amount = np.where(bills['income'], bills['amount'], -bills['amount'])
+        self.bill_income = bills['income']
+        self.bill_date = to_days(bills['date'])
+        self.bill_account = bills['account']
+        self.bill_comments = comments
+        self.transfer_amount = transfers['amount']
+        self.transfer_date = to_days(transfers['date'])
+        self.transfer_from = transfers['from_account']
+        self.transfer_to = transfers['to_account']
+
+    def month_sumup(self):
+        """
+        Sum up normal_income, normal_outcome and transfer per month, with the
+        same meaning as the month statistics maintained by DatabaseDriver.
+        Transfers between the user's own accounts add up to zero.
+        Return {'YYYY-MM': {field: sum in yuan}}.
+        """
+        months = self.bill_date.astype('M8[M]')
+        income = self.bill_income
+        sumups = {}
+        for field, mask, sign in (('normal_income', income, 1),
+                                  ('normal_outcome', ~income, -1)):
+            keys, sums = group_sum(months[mask], sign * self.bill_amount[mask])
+            for key, value in zip(keys, sums):
+                sumups.setdefault(str(key), {})[field] = from_cents(value)
+        keys = np.unique(self.transfer_date.astype('M8[M]'))
+        for key in keys:
+            sumups.setdefault(str(key), {})['transfer'] = from_cents(0)
+        for item in sumups.values():
+            for field in ('normal_income', 'normal_outcome', 'transfer'):
+                item.setdefault(field, from_cents(0))
+        return dict(sorted(sumups.items()))
+
+    def month_account_matrix(self):
+        """
+        Net bill amount per month and account.
+        Return (months, account_ids, matrix[month, account]).
+        """
+        months, month_index = np.unique(self.bill_date.astype('M8[M]'),
+                                        return_inverse=True)
+        accounts, account_index = np.unique(self.bill_account, return_inverse=True)
+        matrix = np.zeros((len(months), len(accounts)), dtype=self.bill_amount.dtype)
+        np.add.at(matrix, (month_index, account_index), self.bill_amount)
+        return months, accounts, matrix
+
+    def spend_per_month(self):
+        """Return (months, outcome) of every month with outcome bills."""
+        mask = ~self.bill_income
+        return group_sum(self.bill_date[mask].astype('M8[M]'), -self.bill_amount[mask])
+
+    def keyword_mask(self, keyword):
+        """Bills whose comments contain keyword, needs comments loaded."""
+        if self.bill_comments is None:
+            raise ValueError("Ledger is loaded without comments.")
+        return np.char.find(self.bill_comments, keyword) >= 0
+
+    def keyword_sum(self, keyword):
+        """Net amount of the bills whose comments contain keyword."""
+        return self.bill_amount[self.keyword_mask(keyword)].sum()
+
+    def account_deltas(self, account_id, is_credit=False):
+        """Dated balance changes of an account, direction as remain_balance."""
+        sign = balance_sign(is_credit)
+        bill_mask = self.bill_account == account_id
+        out_mask = self.transfer_from == account_id
+        in_mask = self.transfer_to == account_id
+        dates = np.concatenate((self.bill_date[bill_mask],
+                                self.transfer_date[out_mask],
+                                self.transfer_date[in_mask]))
+        deltas = sign * np.concatenate((self.bill_amount[bill_mask],
+                                        -self.transfer_amount[out_mask],
+                                        self.transfer_amount[in_mask]))
+        return dates, deltas
+
+    def balance_series(self, account_id, is_credit=False, init_balance=0):
+        """
+        Balance at the end of every day with movement of an account.
+        Return (days, balances).
+        """
+        dates, deltas = self.account_deltas(account_id, is_credit)
+        days, sums = group_sum(dates, deltas)
+        return days, init_balance + np.cumsum(sums)
+
+    def month_balance_deltas(self, account_id, is_credit=False):
+        """Return (months, net change of every month, change against previous month)."""
+        dates, deltas = self.account_deltas(account_id, is_credit)
+        months, sums = group_sum(dates.astype('M8[M]'), deltas)
+        return months, sums, period_deltas(sums)
+
+def load_bills(driver, start_date=None, end_date=None, with_comments=False):
+    query = (driver.bills_query(start_date=start_date, end_date=end_date)
+             .select(Bill.amount, Bill.inout_type, Bill.billing_date,
+                     Bill.account_id, Bill.comments)
+             .where(Bill.billing_date.is_null(False))
+             .tuples())
+    comments = [] if with_comments else None
+    def rows():
+        for amount, inout, date, account_id, comment in stream(query):
+            if comments is not None:
+                comments.append(comment or '')
+            yield amount, inout == '收入', date.toordinal(), account_id
+    bills = np.fromiter(rows(), dtype=BILL_DTYPE)
+    if comments is not None:
+        comments = np.array(comments, dtype=str)
+    return bills, comments
+
+def load_transfers(driver, start_date=None, end_date=None):
+    query = (driver.transfers_query(start_date=start_date, end_date=end_date)
+             .select(Transfer.amount, Transfer.transfer_date,
+                     Transfer.from_account_id, Transfer.to_account_id)
+             .where(Transfer.transfer_date.is_null(False))
+             .tuples())
+    return np.fromiter(((amount, date.toordinal(), from_id, to_id)
+                        for amount, date, from_id, to_id in stream(query)),
+                       dtype=TRANSFER_DTYPE)
+
+def load_ledger(driver, start_date=None, end_date=None, with_comments=False):
+    """Load current user's bills and transfers in date range into a Ledger."""
+    bills, comments = load_bills(driver, start_date, end_date, with_comments)
+    transfers = load_transfers(driver, start_date, end_date)
+    return Ledger(bills, transfers, comments)
+
+def load_columns(directory, kind, rows):
+    columns = {}
+    for name in os.listdir(os.path.join(directory, kind)):
+        if name.endswith('.npy'):
+            array = np.load(os.path.join(directory, kind, name), mmap_mode='r')
+            columns[name[:-4]] = array[:rows]
+    return columns
+
+def load_export(directory):
+    """Memory-map a binary export (see export.py) as a Ledger."""
+    with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+    kinds = meta['kinds']
+    bills = load_columns(directory, 'bills', kinds['bills']['rows'])
+    transfers = load_columns(directory, 'transfers', kinds['transfers']['rows'])
+    return Ledger(bills, transfers)
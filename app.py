@@ -1,6 +1,92 @@
 # -*- coding:utf-8 -*-
-from peewee import MySQLDatabase
+"""
+This module is used for choose and configure the database backend.
+
+Backend is configured by environment variables (or configure_database()):
+    FINANSE_DB_BACKEND          mysql (default) or sqlite
+    FINANSE_DB_NAME             database name, or file path (':memory:' for
+                                an in-memory database) with sqlite
+    FINANSE_DB_HOST, FINANSE_DB_PORT, FINANSE_DB_USER, FINANSE_DB_PASSWORD
+    FINANSE_DB_MAX_CONNECTIONS  size of the MySQL connection pool
+    FINANSE_DB_STALE_TIMEOUT    seconds before a pooled connection is recycled
+
+Nothing is connected at import time. The database is built from the
+configuration on first use and connections are opened lazily by the first
+query.
+"""
+import os
+from peewee import DatabaseProxy, SqliteDatabase
+from playhouse.pool import PooledMySQLDatabase
+
+DEFAULT_CONFIG = {
+    'backend': 'mysql',
+    'name': 'Finanse',
+    'host': 'localhost',
+    'port': 3306,
+    'user': 'root',
+    'password': '',
+    'max_connections': 8,
+    'stale_timeout': 300,
+}
+
+INT_OPTIONS = ('port', 'max_connections', 'stale_timeout')
+
+ENV_PREFIX = 'FINANSE_DB_'
+
+def load_config(config=None, **overrides):
+    """Merge default, environment, config dict and keyword overrides in order."""
+    merged = dict(DEFAULT_CONFIG)
+    for key in DEFAULT_CONFIG:
+        value = os.environ.get(ENV_PREFIX + key.upper())
+        if value is not None:
+            merged[key] = value
+    merged.update(config or {})
+    merged.update(overrides)
+    for key in INT_OPTIONS:
+        merged[key] = int(merged[key])
+    return merged
+
+def make_database(config):
+    backend = config['backend']
+    if backend == 'mysql':
+        return PooledMySQLDatabase(config['name'], host=config['host'],
+                                   port=config['port'], user=config['user'],
+                                   passwd=config['password'],
+                                   max_connections=config['max_connections'],
+                                   stale_timeout=config['stale_timeout'])
+    if backend == 'sqlite':
+        pragmas = {'foreign_keys': 1}
+        if config['name'] != ':memory:':
+            pragmas['journal_mode'] = 'wal'
+        return SqliteDatabase(config['name'], pragmas=pragmas)
+    raise ValueError("Unknown database backend %s." % backend)
+
+class LazyDatabase(DatabaseProxy):
+    """Database proxy which builds the configured database on first use."""
+
+    def get_database(self):
+        if self.obj is None:
+            self.initialize(make_database(load_config()))
+        return self.obj
+
+    def __getattr__(self, attr):
+        return getattr(self.get_database(), attr)
+
+    def __enter__(self):
+        return self.get_database().__enter__()
+
+    def __exit__(self, *args):
+        return self.get_database().__exit__(*args)
 
 # use current database
-db = MySQLDatabase('Finanse', user='root', passwd='yangliuming')
+db = LazyDatabase()
+
+def configure_database(config=None, **overrides):
+    """Replace the database behind db, models follow automatically."""
+    if db.obj is not None and not db.obj.is_closed():
+        db.obj.close()
+    db.initialize(make_database(load_config(config, **overrides)))
+    return db
 
+def is_sqlite():
+    return isinstance(db.get_database(), SqliteDatabase)
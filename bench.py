@@ -0,0 +1,183 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for benchmark DatabaseDriver hot paths on a synthetic
+ledger (see datagen.py). Results are written as JSON so that runs of
+different versions can be compared with --baseline.
+
+SQLite runs on a fresh temporary file. MySQL runs only with --mysql, against
+the database configured by FINANSE_DB_* variables; use a database dedicated
+to benchmarks, generated rows are never cleaned up.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time as timer
+from datetime import datetime
+from utils import info, warning
+
+import peewee
+import app
+from dbdriver import DatabaseDriver
+from datagen import Generator, PRESETS
+from importer import Importer
+from ingest import Ingestor
+from schema import SCHEMA_VERSION
+
+class Benchmark():
+    def __init__(self, backend, repeat=3):
+        self.backend = backend
+        self.repeat = repeat
+        self.results = []
+
+    def run(self, case, func, rows=None, repeat=None):
+        """Time func (printing muted) and record the best and median runs."""
+        times = []
+        for _ in range(repeat or self.repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = timer.perf_counter()
+                func()
+                times.append(timer.perf_counter() - start)
+        result = {'backend': self.backend, 'case': case, 'runs': len(times),
+                  'best': min(times), 'median': statistics.median(times)}
+        if rows:
+            result['rows'] = rows
+            result['rows_per_second'] = rows / result['best']
+        self.results.append(result)
+        info("%-8s %-22s best %.4fs median %.4fs%s" %
+                (self.backend, case, result['best'], result['median'],
+                 " (%.0f rows/s)" % result['rows_per_second'] if rows else ""))
+        return result
+
+def month_range(start, months):
+    year, month = start.year, start.month
+    for _ in range(months):
+        yield "%04d-%02d" % (year, month)
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+def run_cases(bench, driver, preset, seed):
+    generator = Generator(preset, seed)
+    sizes = generator.sizes
+
+    counts = {}
+    def populate():
+        counts.update(generator.populate(driver))
+    bench.run('populate', populate, rows=sizes['users'] * (sizes['bills'] + sizes['transfers']),
+              repeat=1)
+
+    # a separate user for write cases, so reads see the populated ledger only
+    writer = Generator(preset, seed + 1, users=1)
+    writer.create_user(driver, 0)
+    bench.run('create_accounts', lambda: writer.create_accounts(driver),
+              rows=len(writer.account_names()), repeat=1)
+    with tempfile.TemporaryDirectory() as directory:
+        files = writer.write_csv(directory, driver.get_user().nickname)
+        importer = Importer(driver, batch_size=1000)
+        bench.run('import_bills', lambda: importer.import_bills(files['bills']),
+                  rows=sizes['bills'], repeat=1)
+        bench.run('ingest_transfers', lambda: Ingestor(batch_size=1000).run([files['transfers']]),
+                  rows=sizes['transfers'], repeat=1)
+
+    generator.create_user(driver, 0)
+    # reports are computed every time, cached reads have their own cases
+    driver.reports.enabled = False
+    accounts = list(driver.get_account_map().values())
+    months = list(month_range(generator.start, sizes['months']))
+    bills = sum(1 for account in accounts for bill in driver.get_all_bills(account))
+
+    bench.run('get_all_bills', lambda: [list(driver.get_all_bills(account))
+                                        for account in accounts], rows=bills)
+    bench.run('iter_bills', lambda: sum(1 for bill in driver.iter_bills()), rows=bills)
+    bench.run('month_stat_sumup', lambda: [driver.month_stat_sumup(month)
+                                           for month in months])
+    bench.run('account_stat_sumup', lambda: [driver.account_stat_sumup(account.account_name, month)
+                                             for account in accounts for month in months])
+    bench.run('stat_report_range', lambda: driver.stat_report(months[0], months[-1]))
+    bench.run('search_bills', lambda: driver.search_bills('买菜', page_size=100))
+    bench.run('overview', lambda: [len(account.bills) for account in
+                                   driver.get_account_overview()], rows=bills)
+    driver.reports.enabled = True
+    bench.run('stat_report_cached', lambda: driver.stat_report(months[0], months[-1]))
+    bench.run('overview_cached', lambda: driver.get_account_overview(), rows=bills)
+
+def cold_start(bench, config):
+    """Time a new manage.py process from start to its schema check and exit."""
+    env = dict(os.environ)
+    env.update((app.ENV_PREFIX + key.upper(), str(value)) for key, value in config.items())
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            'manage.py'), 'schema']
+    bench.run('cold_start', lambda: subprocess.run(command, env=env, check=True,
+                                                   stdout=subprocess.DEVNULL))
+
+def compare(results, baseline, tolerance):
+    """Print cases slower than baseline by more than tolerance, return their count."""
+    old = {(item['backend'], item['case']): item for item in baseline['results']}
+    regressions = 0
+    for item in results:
+        before = old.get((item['backend'], item['case']))
+        if not before:
+            continue
+        ratio = item['best'] / before['best']
+        if ratio > 1 + tolerance:
+            regressions += 1
+            warning("%s %s regressed: %.4fs -> %.4fs (x%.2f)" %
+                    (item['backend'], item['case'], before['best'], item['best'], ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Finanse database driver.")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='tiny')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--mysql', action='store_true',
+                        help="also run on the configured MySQL database")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help="previous results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown against baseline, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+
+    backends = [('sqlite', None)]
+    if args.mysql:
+        backends.append(('mysql', {'backend': 'mysql'}))
+
+    results = []
+    for backend, config in backends:
+        with tempfile.TemporaryDirectory() as directory:
+            if config is None:
+                config = {'backend': 'sqlite', 'name': os.path.join(directory, 'bench.db')}
+            app.configure_database(config)
+            bench = Benchmark(backend, args.repeat)
+            with contextlib.redirect_stdout(io.StringIO()):
+                driver = DatabaseDriver()
+            run_cases(bench, driver, args.preset, args.seed)
+            app.db.close()
+            cold_start(bench, config)
+            results.extend(bench.results)
+
+    report = {'meta': {'preset': args.preset, 'seed': args.seed,
+                       'schema_version': SCHEMA_VERSION,
+                       'python': platform.python_version(),
+                       'peewee': peewee.__version__,
+                       'time': datetime.now().isoformat(timespec='seconds')},
+              'results': results}
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(report, output, indent=2, ensure_ascii=False)
+    info("Results written to %s." % args.output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline:
+            if compare(results, json.load(baseline), args.tolerance):
+                return 1
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,206 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for generate synthetic ledgers: users, account groups,
+accounts, bills and transfers (month statistics follow from them through
+DatabaseDriver). Every dataset is reproducible from its preset and seed.
+"""
+import argparse
+import csv
+import os
+import random
+from datetime import date, timedelta
+from utils import info
+
+from dbmodel import User
+from dbdriver import DatabaseDriver
+
+PRESETS = {
+    'tiny': {'users': 1, 'accounts': 4, 'bills': 500, 'transfers': 50, 'months': 6},
+    'small': {'users': 2, 'accounts': 8, 'bills': 20000, 'transfers': 2000, 'months': 24},
+    'medium': {'users': 4, 'accounts': 12, 'bills': 250000, 'transfers': 25000, 'months': 60},
+    'large': {'users': 8, 'accounts': 16, 'bills': 1000000, 'transfers': 100000, 'months': 120},
+}
+
+# (group name, account names)
+GROUPS = (
+    ('日常开支', ('浦发银行信用卡', '招商银行信用卡', '支付宝', '微信钱包')),
+    ('储备消费', ('工商银行储蓄卡', '建设银行储蓄卡', '现金')),
+    ('保本应急', ('朝朝盈', '余额宝', '零钱通')),
+    ('投资理财', ('基金账户', '股票账户', '债券账户')),
+)
+CREDIT_ACCOUNTS = ('浦发银行信用卡', '招商银行信用卡')
+
+# (comments, inout, mean amount in yuan, weight)
+BILL_KINDS = (
+    ('买菜', '支出', 60, 30),
+    ('午饭', '支出', 25, 30),
+    ('打车', '支出', 30, 10),
+    ('网购', '支出', 150, 10),
+    ('房租', '支出', 3000, 2),
+    ('水电煤', '支出', 200, 3),
+    ('工资', '收入', 8000, 2),
+    ('利息', '收入', 5, 3),
+    ('捡钱', '收入', 3, 1),
+)
+TRANSFER_COMMENTS = ('转入投资', '还信用卡', '取现', '转出备用')
+
+BATCH_SIZE = 1000
+
+class Generator():
+    def __init__(self, preset='tiny', seed=0, start=date(2020, 1, 1), **sizes):
+        self.sizes = dict(PRESETS[preset])
+        self.sizes.update(sizes)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.start = start
+        self.days = self.sizes['months'] * 365 // 12
+        self.kind_weights = [kind[3] for kind in BILL_KINDS]
+
+    def random_date(self):
+        return self.start + timedelta(days=self.rng.randrange(self.days))
+
+    def random_time(self):
+        return "%02d:%02d:%02d" % (self.rng.randrange(24), self.rng.randrange(60),
+                                   self.rng.randrange(60))
+
+    def random_amount(self, mean):
+        # log-normal around mean, rounded to cents
+        return "%.2f" % (mean * self.rng.lognormvariate(0, 0.5))
+
+    def account_names(self):
+        names = [(group, name) for group, accounts in GROUPS for name in accounts]
+        count = self.sizes['accounts']
+        # more accounts than the templates, number the extra ones
+        extra = [(group, '%s%d' % (name, index + 2))
+                 for index in range(count // len(names))
+                 for group, name in names]
+        return (names + extra)[:count]
+
+    def bill_rows(self, nickname, account_names):
+        """Bills of a user in the importer CSV layout."""
+        for _ in range(self.sizes['bills']):
+            comments, inout, mean, weight = self.rng.choices(BILL_KINDS,
+                                                             self.kind_weights)[0]
+            yield {'amount': self.random_amount(mean), 'inout': inout,
+                   'account': self.rng.choice(account_names),
+                   'billing_date': self.random_date().isoformat(),
+                   'billing_time': self.random_time(), 'comments': comments,
+                   'book': '%s的日常账本' % nickname, 'user': nickname}
+
+    def transfer_rows(self, nickname, account_names):
+        """Transfers of a user in the importer CSV layout."""
+        for _ in range(self.sizes['transfers']):
+            from_account, to_account = self.rng.sample(account_names, 2)
+            yield {'amount': self.random_amount(1000),
+                   'transfer_date': self.random_date().isoformat(),
+                   'transfer_time': self.random_time(),
+                   'comments': self.rng.choice(TRANSFER_COMMENTS),
+                   'from_account': from_account, 'to_account': to_account,
+                   'book': '%s的日常账本' % nickname, 'user': nickname}
+
+    def create_user(self, driver, index):
+        nickname = 'bench%d_%d' % (self.seed, index)
+        user = User.get_or_create(email='%s@finanse.test' % nickname,
+                                  defaults={'password': 'bench', 'nickname': nickname})[0]
+        driver.current_user = user
+        return user
+
+    def create_accounts(self, driver):
+        accounts = []
+        for group, name in self.account_names():
+            driver.create_account_group(group)
+            accounts.append(driver.create_account(name, is_credit=name in CREDIT_ACCOUNTS,
+                                                  group_name=group))
+        return accounts
+
+    def populate(self, driver):
+        """
+        Write the whole dataset through driver bulk APIs, so month statistics
+        and balances are maintained like for real imports.
+        Return {'users', 'accounts', 'bills', 'transfers'} counts.
+        """
+        counts = {'users': 0, 'accounts': 0, 'bills': 0, 'transfers': 0}
+        for index in range(self.sizes['users']):
+            user = self.create_user(driver, index)
+            accounts = {account.account_name: account
+                        for account in self.create_accounts(driver)}
+            names = list(accounts)
+            counts['users'] += 1
+            counts['accounts'] += len(accounts)
+
+            # written like a statement, populating again adds nothing
+            occurrences = {}
+            batch = []
+            for row in self.bill_rows(user.nickname, names):
+                batch.append({'amount': row['amount'], 'inout': row['inout'],
+                              'account': accounts[row['account']],
+                              'date': row['billing_date'], 'time': row['billing_time'],
+                              'comments': row['comments']})
+                if len(batch) >= BATCH_SIZE:
+                    counts['bills'] += driver.create_bills(batch, occurrences)['inserted']
+                    batch = []
+            counts['bills'] += driver.create_bills(batch, occurrences)['inserted']
+
+            occurrences = {}
+            batch = []
+            for row in self.transfer_rows(user.nickname, names):
+                batch.append({'amount': row['amount'],
+                              'from_account': accounts[row['from_account']],
+                              'to_account': accounts[row['to_account']],
+                              'date': row['transfer_date'], 'time': row['transfer_time'],
+                              'comments': row['comments']})
+                if len(batch) >= BATCH_SIZE:
+                    counts['transfers'] += driver.create_transfers(batch, occurrences)['inserted']
+                    batch = []
+            counts['transfers'] += driver.create_transfers(batch, occurrences)['inserted']
+        info("Generated %(users)d users, %(accounts)d accounts, %(bills)d bills "
+             "and %(transfers)d transfers." % counts)
+        return counts
+
+    def write_csv(self, directory, nickname):
+        """Write accounts, bills and transfers CSV files of one user."""
+        os.makedirs(directory, exist_ok=True)
+        names = self.account_names()
+        files = {}
+        path = os.path.join(directory, 'accounts.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(('name', 'is_credit', 'init_balance', 'remain_balance',
+                             'currency', 'group', 'user'))
+            for group, name in names:
+                writer.writerow((name, name in CREDIT_ACCOUNTS, 0.0, 0.0, 'RMB',
+                                 group, nickname))
+        files['accounts'] = path
+        account_names = [name for group, name in names]
+        for kind, rows in (('bills', self.bill_rows(nickname, account_names)),
+                           ('transfers', self.transfer_rows(nickname, account_names))):
+            path = os.path.join(directory, kind + '.csv')
+            with open(path, 'w', encoding='utf-8', newline='') as csv_file:
+                writer = None
+                for row in rows:
+                    if writer is None:
+                        writer = csv.DictWriter(csv_file, fieldnames=list(row))
+                        writer.writeheader()
+                    writer.writerow(row)
+            files[kind] = path
+        return files
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic Finanse ledger.")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='tiny')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', metavar='DIR',
+                        help="write CSV files of one user instead of the database")
+    args = parser.parse_args(argv)
+
+    generator = Generator(args.preset, args.seed)
+    if args.csv:
+        files = generator.write_csv(args.csv, 'bench%d_0' % args.seed)
+        info("CSV files written: %s" % ", ".join(files.values()))
+        return 0
+
+    generator.populate(DatabaseDriver())
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
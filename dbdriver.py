@@ -2,12 +2,132 @@
 """
 This module is used for drive database and provide APIs to operate the database.
 """
-from datetime import datetime
+import operator
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import reduce
 from utils import info, error, warning, ask
 
 from dbmodel import User, Bill, Transfer, \
-                          Account, AccountGroup, AccountStatMonth
-from app import db
+                          Account, AccountGroup, AccountStatMonth, WriteVersion
+from app import db, is_sqlite
+from money import to_cents, from_cents
+from schema import ensure_schema
+import search
+from reportcache import ReportCache, REPORT_CACHE_SIZE, MISSING
+from fingerprint import assign_hashes, merge_occurrences, bill_values, transfer_values
+from peewee import fn, prefetch, IntegrityError, mysql as mysql_driver
+
+STAT_FIELDS = ('amount', 'adjust', 'interest_income', 'invest_income',
+               'normal_income', 'normal_outcome', 'transfer')
+# month statistics only typed in; the others follow bill and transfer writes
+TYPED_STAT_FIELDS = ('amount', 'adjust', 'interest_income', 'invest_income')
+
+# number of account and group instances kept by DatabaseDriver lookups
+LOOKUP_CACHE_SIZE = 256
+
+# write version month of writes not bound to a month: accounts, groups,
+# undated bills and transfers, fixed balances
+UNDATED_MONTH = '1000-01-01'
+
+def month_str(date):
+    """Format a date (or 'YYYY-MM-DD' string) as 'YYYY-MM'."""
+    if isinstance(date, str):
+        return date[:7]
+    return date.strftime('%Y-%m')
+
+def month_start(date):
+    """First day of the month of a date (or 'YYYY-MM-DD' string), as 'YYYY-MM-01'."""
+    return month_str(date) + '-01'
+
+def next_month(month):
+    """First day of the month after month ('YYYY-MM'), as 'YYYY-MM-01'."""
+    year, mon = int(month[:4]), int(month[5:7])
+    if mon == 12:
+        return '%04d-01-01' % (year + 1)
+    return '%04d-%02d-01' % (year, mon + 1)
+
+def previous_day(date):
+    """The day before a date (or 'YYYY-MM-DD' string), as 'YYYY-MM-DD'."""
+    day = datetime.strptime(str(date)[:10], '%Y-%m-%d').date()
+    return (day - timedelta(days=1)).isoformat()
+
+def month_of(field):
+    """SQL expression of the 'YYYY-MM' month of a date column."""
+    if is_sqlite():
+        return fn.strftime('%Y-%m', field)
+    return fn.DATE_FORMAT(field, '%Y-%m')
+
+def written_months(deltas, rows):
+    """Months of write versions touched by inserted rows and their deltas."""
+    months = set(date for account_id, date in deltas)
+    if any(not (row.get('billing_date') or row.get('transfer_date')) for row in rows):
+        months.add(UNDATED_MONTH)
+    return months
+
+def add_bill_delta(deltas, account_id, date, inout, amount):
+    if not date:
+        return
+    field = 'normal_income' if inout == '收入' else 'normal_outcome'
+    fields = deltas.setdefault((account_id, month_start(date)), {})
+    fields[field] = fields.get(field, 0) + amount
+
+def balance_sign(is_credit):
+    """
+    Direction of remain_balance. Debit accounts keep the money left, credit
+    accounts keep the money owed, so every movement is reversed for them.
+    """
+    return -1 if is_credit else 1
+
+def bill_balance_delta(inout, amount, is_credit):
+    if inout == '收入':
+        return balance_sign(is_credit) * amount
+    return -balance_sign(is_credit) * amount
+
+def add_transfer_delta(deltas, from_account_id, to_account_id, date, amount):
+    if not date:
+        return
+    month = month_start(date)
+    fields = deltas.setdefault((from_account_id, month), {})
+    fields['transfer'] = fields.get('transfer', 0) - amount
+    fields = deltas.setdefault((to_account_id, month), {})
+    fields['transfer'] = fields.get('transfer', 0) + amount
+
+def stream(query):
+    """
+    Iterate query results without caching them in the query. On MySQL the
+    rows come from a server side cursor, so the connection can not run any
+    other query until the iteration ends.
+    """
+    if is_sqlite() or mysql_driver is None:
+        return query.iterator()
+    return server_side_iterator(query)
+
+def server_side_iterator(query):
+    sql, params = query.sql()
+    cursor = db.connection().cursor(mysql_driver.cursors.SSCursor)
+    try:
+        cursor.execute(sql, params)
+        yield from query._get_cursor_wrapper(cursor).iterator()
+    finally:
+        cursor.close()
+
+def keyset_page(query, date_field, id_field, page_size, token=None):
+    """
+    Fetch a page after token ('YYYY-MM-DD:id' of the last row of previous
+    page) ordered by (date_field, id_field). Return (rows, next_token).
+    """
+    query = query.where(date_field.is_null(False))
+    if token:
+        date, last_id = token.rsplit(':', 1)
+        query = query.where((date_field > date) |
+                            ((date_field == date) & (id_field > int(last_id))))
+    rows = list(query.order_by(date_field, id_field).limit(page_size + 1))
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, "%s:%d" % (getattr(last, date_field.name), last.id)
 
 class NotFindItemError(Exception):
     def __init__(self, message):
@@ -15,58 +135,282 @@ class NotFindItemError(Exception):
         self.message = message
     pass
 
+class LookupCache():
+    """
+    Bounded LRU cache of looked up model instances, keyed by
+    (kind, user_id, name). Cached instances only stand for identity, read
+    balances with DatabaseDriver.get_balance().
+    """
+    def __init__(self, size=LOOKUP_CACHE_SIZE, enabled=True):
+        self.size = size
+        self.enabled = enabled
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        try:
+            item = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def put(self, key, item):
+        if not self.enabled:
+            return
+        self.items[key] = item
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def invalidate(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.items), 'enabled': self.enabled}
+
 class DatabaseDriver():
-    def __init__(self):
-        self.current_user = None
+    def __init__(self, use_cache=True, cache_size=LOOKUP_CACHE_SIZE, use_report_cache=True,
+                 report_cache_size=REPORT_CACHE_SIZE, report_cache_dir=None, user=None):
+        # user is set for drivers working on behalf of a known user, others
+        # call login() or authenticate()
+        self.current_user = user
+        self.cache = LookupCache(cache_size, enabled=use_cache)
+        self.reports = ReportCache(report_cache_size, report_cache_dir,
+                                   enabled=use_report_cache)
         self.create_database()
 
     def get_user(self):
         return self.current_user
 
+    def authenticate(self, email, password):
+        """Non-interactive login, used by batch tools instead of login()."""
+        try:
+            user = User.get(email=email, password=password)
+        except User.DoesNotExist:
+            return False
+        self.current_user = user
+        return True
+
     # May throw exception
     def get_account(self, name):
+        key = ('account', self.current_user.id, name)
+        account = self.cache.get(key)
+        if account is not None:
+            return account
         try:
-            account = Account.get(account_name=name)
+            account = Account.get(account_name=name, user_id=self.current_user.id)
         except Account.DoesNotExist:
             raise NotFindItemError("Not find account %s." % name)
         else:
+            self.cache.put(key, account)
             return account
 
     # May throw exception
     def get_account_group(self, name):
+        key = ('group', self.current_user.id, name)
+        group = self.cache.get(key)
+        if group is not None:
+            return group
         try:
-            group = AccountGroup.get(account_group_name=name)
+            group = AccountGroup.get(account_group_name=name, user_id=self.current_user.id)
         except AccountGroup.DoesNotExist:
             raise NotFindItemError("Not find account group %s." % name)
         else:
+            self.cache.put(key, group)
             return group
 
+    def cache_stats(self):
+        """Hit and miss counters of the account and group lookup cache."""
+        return self.cache.stats()
+
+    def report_cache_stats(self):
+        """Hit, stale and miss counters and hit rate of the report cache."""
+        return self.reports.stats()
+
+    def bump_versions(self, months):
+        """
+        Count a write of current user in months ('YYYY-MM-01' or
+        UNDATED_MONTH), cached reports over them become stale. Call it in
+        the transaction of the write.
+        """
+        months = sorted(set(str(month) for month in months))
+        if not months or self.current_user is None:
+            return
+        update = {WriteVersion.version: WriteVersion.version + 1}
+        query = WriteVersion.insert_many([{'user_id': self.current_user.id, 'month': month,
+                                           'version': 1} for month in months])
+        if is_sqlite():
+            query = query.on_conflict(conflict_target=[WriteVersion.user_id,
+                                                       WriteVersion.month],
+                                      update=update)
+        else:
+            query = query.on_conflict(update=update)
+        query.execute()
+
+    def write_fingerprint(self, user_id=None, start=None, end=None):
+        """
+        Sum of write versions of a user (all users for None) from start to
+        end months ('YYYY-MM-01', included, None for no bound), undated
+        writes included. It grows with every write which may change a
+        report over these months.
+        """
+        query = WriteVersion.select(fn.SUM(WriteVersion.version))
+        if user_id is not None:
+            query = query.where(WriteVersion.user_id==user_id)
+        if start or end:
+            months = WriteVersion.month==UNDATED_MONTH
+            if start and end:
+                months |= WriteVersion.month.between(start, end)
+            elif start:
+                months |= WriteVersion.month >= start
+            else:
+                months |= WriteVersion.month <= end
+            query = query.where(months)
+        return int(query.scalar() or 0)
+
+    def cached_report(self, name, params, compute, start=None, end=None, all_users=False):
+        """
+        Return compute() through the report cache, keyed by user, name and
+        params and checked against the write versions from start to end
+        months. Cached reports are shared, do not modify them.
+        """
+        if not self.reports.enabled:
+            return compute()
+        user_id = None if all_users else self.current_user.id
+        key = (db.get_database().database, name, user_id, params)
+        # read before computing, a write in between makes the entry stale
+        fingerprint = self.write_fingerprint(user_id, start, end)
+        report = self.reports.get(key, fingerprint)
+        if report is MISSING:
+            report = compute()
+            self.reports.put(key, fingerprint, report)
+        return report
+
+    def get_account_map(self):
+        """Return {account_name: Account} of current user in one query."""
+        accounts = Account.select().where(Account.user_id==self.current_user.id)
+        accounts = {account.account_name: account for account in accounts}
+        for name, account in accounts.items():
+            self.cache.put(('account', self.current_user.id, name), account)
+        return accounts
+
     def get_all_accounts(self):
         accounts = Account.select().execute()
         return accounts
 
     def get_all_bills(self, account):
-        bills = Bill.select().where(Bill.account_id==account.id and
+        bills = Bill.select().where(Bill.account_id==account.id,
                                     Bill.user_id==self.current_user.id).execute()
         return bills
 
+    def bills_query(self, account=None, start_date=None, end_date=None, inout=None):
+        """Current user's bills filtered by account, date range (included) and inout type."""
+        query = Bill.select().where(Bill.user_id==self.current_user.id)
+        if account is not None:
+            query = query.where(Bill.account_id==account.id)
+        if start_date:
+            query = query.where(Bill.billing_date >= start_date)
+        if end_date:
+            query = query.where(Bill.billing_date <= end_date)
+        if inout:
+            query = query.where(Bill.inout_type==inout)
+        return query
+
+    def transfers_query(self, account=None, start_date=None, end_date=None):
+        """Current user's transfers from or to account, in date range (included)."""
+        query = Transfer.select().where(Transfer.user_id==self.current_user.id)
+        if account is not None:
+            query = query.where((Transfer.from_account_id==account.id) |
+                                (Transfer.to_account_id==account.id))
+        if start_date:
+            query = query.where(Transfer.transfer_date >= start_date)
+        if end_date:
+            query = query.where(Transfer.transfer_date <= end_date)
+        return query
+
+    def iter_bills(self, account=None, start_date=None, end_date=None, inout=None):
+        """Stream bills ordered by date, one model instance at a time."""
+        query = self.bills_query(account, start_date, end_date, inout)
+        return stream(query.order_by(Bill.billing_date, Bill.id))
+
+    def iter_transfers(self, account=None, start_date=None, end_date=None):
+        """Stream transfers ordered by date, one model instance at a time."""
+        query = self.transfers_query(account, start_date, end_date)
+        return stream(query.order_by(Transfer.transfer_date, Transfer.id))
+
+    def get_bills_page(self, account=None, start_date=None, end_date=None,
+                       inout=None, page_size=100, token=None):
+        """
+        One page of bills ordered by (billing_date, id). Pass the returned
+        token back to get the next page, it is None on the last page.
+        Bills without billing_date are not paged.
+        """
+        query = self.bills_query(account, start_date, end_date, inout)
+        return keyset_page(query, Bill.billing_date, Bill.id, page_size, token)
+
+    def get_transfers_page(self, account=None, start_date=None, end_date=None,
+                           page_size=100, token=None):
+        """Same as get_bills_page(), ordered by (transfer_date, id)."""
+        query = self.transfers_query(account, start_date, end_date)
+        return keyset_page(query, Transfer.transfer_date, Transfer.id,
+                           page_size, token)
+
+    def search_bills(self, text, account=None, start_date=None, end_date=None,
+                     inout=None, page_size=100, token=None):
+        """
+        One page of bills whose comments contain every word of text, found
+        through the search index and filtered like get_bills_page().
+        Return (bills, next page token) ordered by (billing_date, id).
+        """
+        query = search.match(self.bills_query(account, start_date, end_date, inout),
+                             Bill, text)
+        return keyset_page(query, Bill.billing_date, Bill.id, page_size, token)
+
+    def search_transfers(self, text, account=None, start_date=None, end_date=None,
+                         page_size=100, token=None):
+        """Same as search_bills(), for transfers ordered by (transfer_date, id)."""
+        query = search.match(self.transfers_query(account, start_date, end_date),
+                             Transfer, text)
+        return keyset_page(query, Transfer.transfer_date, Transfer.id, page_size, token)
+
+    def get_account_overview(self):
+        """
+        Return current user's accounts with their group, bills and month
+        statistics, in three queries whatever the number of accounts.
+        The group is joined as account.account_group_id, bills and month
+        statistics are prefetched as account.bills and
+        account.AccountStatMonths lists. The result is cached.
+        """
+        return self.cached_report('overview', (), self.compute_account_overview)
+
+    def compute_account_overview(self):
+        accounts = (Account
+                    .select(Account, AccountGroup)
+                    .join(AccountGroup)
+                    .where(Account.user_id==self.current_user.id)
+                    .order_by(Account.id))
+        bills = (Bill.select()
+                 .where(Bill.user_id==self.current_user.id)
+                 .order_by(Bill.billing_date, Bill.id))
+        stat_months = AccountStatMonth.select().order_by(AccountStatMonth.date)
+        return prefetch(accounts, bills, stat_months)
+
     def get_all_stat_months(self, account):
         stat_months = AccountStatMonth.select().where(AccountStatMonth.account_id==account.id)
         return stat_months
 
     def create_database(self):
-        if not db.table_exists("user"):
-            User.create_table()
-        if not db.table_exists("accountgroup"):
-            AccountGroup.create_table()
-        if not db.table_exists("account"):
-            Account.create_table()
-        if not db.table_exists("bill"):
-            Bill.create_table()
-        if not db.table_exists("transfer"):
-            Transfer.create_table()
-        if not db.table_exists("accountstatmonth"):
-            AccountStatMonth.create_table()
+        ensure_schema()
 
     def login(self):
         email = ask("Input login email: ")
@@ -104,17 +448,17 @@ class DatabaseDriver():
         self.current_user = user[0]
 
     def create_account(self, name, is_credit=False, group_name=None, currency=None):
-        if not group_name:
-            group = AccountGroup.get_or_create(account_group_name="未分组")[0]
-
         if not currency:
             currency = "RMB"
 
-        try:
-            group = AccountGroup.get(account_group_name=group_name, user_id=self.current_user.id)
-        except AccountGroup.DoesNotExist:
-            warning("Account group %s is not existed." % group_name)
-            return None
+        if not group_name:
+            group = self.create_account_group("未分组")
+        else:
+            try:
+                group = self.get_account_group(group_name)
+            except NotFindItemError:
+                warning("Account group %s is not existed." % group_name)
+                return None
 
         account = Account.get_or_create(account_name=name, is_credit=is_credit,
                                         user_id=self.current_user.id,
@@ -122,84 +466,689 @@ class DatabaseDriver():
                                         currency=currency)
 
         if account[1]:
+            self.bump_versions([UNDATED_MONTH])
             info("New account %s created." % name)
         else:
             info("Account %s already existed." % name)
 
-        return account[0]
+        # read again, a created instance misses the columns set by SQL defaults
+        account = Account.get_by_id(account[0].id)
+        self.cache.put(('account', self.current_user.id, name), account)
+        return account
+
+    def rename_account(self, name, new_name):
+        account = self.get_account(name)
+        with db.atomic():
+            Account.update(account_name=new_name).where(Account.id==account.id).execute()
+            self.bump_versions([UNDATED_MONTH])
+        self.cache.invalidate(('account', self.current_user.id, name))
+        self.cache.invalidate(('account', self.current_user.id, new_name))
+        info("Account %s is renamed to %s." % (name, new_name))
+
+    def delete_account(self, name):
+        """Delete an account without any bill, transfer or statistic."""
+        account = self.get_account(name)
+        self.cache.invalidate(('account', self.current_user.id, name))
+        with db.atomic():
+            Account.delete().where(Account.id==account.id).execute()
+            self.bump_versions([UNDATED_MONTH])
+        info("Account %s is deleted." % name)
+
+    def rename_account_group(self, name, new_name):
+        group = self.get_account_group(name)
+        with db.atomic():
+            (AccountGroup.update(account_group_name=new_name)
+             .where(AccountGroup.id==group.id).execute())
+            self.bump_versions([UNDATED_MONTH])
+        self.cache.invalidate(('group', self.current_user.id, name))
+        self.cache.invalidate(('group', self.current_user.id, new_name))
+        info("Account group %s is renamed to %s." % (name, new_name))
+
+    def delete_account_group(self, name):
+        """Delete an account group without any account."""
+        group = self.get_account_group(name)
+        self.cache.invalidate(('group', self.current_user.id, name))
+        with db.atomic():
+            AccountGroup.delete().where(AccountGroup.id==group.id).execute()
+            self.bump_versions([UNDATED_MONTH])
+        info("Account group %s is deleted." % name)
 
     def create_account_group(self, name, comments=None):
         account_group = AccountGroup.get_or_create(account_group_name=name, comments=comments, user_id=self.current_user.id)
 
         if account_group[1]:
+            self.bump_versions([UNDATED_MONTH])
             info("New account group %s created." % name)
         else:
             info("Account group %s already existed." % name)
 
+        self.cache.put(('group', self.current_user.id, name), account_group[0])
         return account_group[0]
 
     def create_account_stat_month(self, month_str, account_name, amount, adjust, interest_income,
                                   invest_income, normal_income, normal_outcome, transfer):
         try:
-            account = Account.get(account_name=account_name, user_id=self.current_user.id)
-        except Account.DoesNotExist:
+            account = self.get_account(account_name)
+        except NotFindItemError:
             warning("Account %s is not existed." % account_name)
             return None
 
-        date_str = month_str + "-01"
-        try:
-            stat_month = AccountStatMonth.get(date=date_str, account_id=account.id)
-            info("Statistic with account %s in month %s-%s is already existed." %
-                    (account.account_name,
-                        datetime.strptime(date_str, '%Y-%m-%d').year,
-                        datetime.strptime(date_str, '%Y-%m-%d').month))
-        except AccountStatMonth.DoesNotExist:
-            stat_month = AccountStatMonth.create(date=date_str, account_id=account.id,
-                                                 amount=amount, adjust=adjust,
-                                                 interest_income=interest_income,
-                                                 invest_income=invest_income,
-                                                 normal_income=normal_income,
-                                                 normal_outcome=normal_outcome,
-                                                 transfer=transfer)
-            info("Statistic with account %s in month %s-%s is inserted." %
-                    (account.account_name,
-                        datetime.strptime(date_str, '%Y-%m-%d').year,
-                        datetime.strptime(date_str, '%Y-%m-%d').month))
+        counts = self.create_account_stat_months([{
+                'month': month_str, 'account': account, 'amount': amount, 'adjust': adjust,
+                'interest_income': interest_income, 'invest_income': invest_income,
+                'normal_income': normal_income, 'normal_outcome': normal_outcome,
+                'transfer': transfer}])
+        if counts['inserted']:
+            info("Statistic with account %s in month %s is inserted." %
+                    (account.account_name, month_str))
+        elif counts['updated']:
+            info("Statistic with account %s in month %s is updated." %
+                    (account.account_name, month_str))
+        else:
+            info("Statistic with account %s in month %s is already existed." %
+                    (account.account_name, month_str))
+        return counts
 
     def create_bill(self, amount, inout, account, date, time, comments):
-        Bill.insert(amount=amount, inout_type=inout, account_id=account.id,
-                    billing_date=date, billing_time=time, comments=comments,
-                    user_id=self.current_user.id).execute()
+        return self.create_bills([{'amount': amount, 'inout': inout, 'account': account,
+                                   'date': date, 'time': time, 'comments': comments}])
 
     def create_transfer(self, amount, from_account, to_account, date, time, comments):
-        Transfer.insert(amount=amount, from_account_id=from_account.id,
-                        to_account_id=to_account.id, transfer_date=date,
-                        transfer_time=time, comments=comments,
-                        user_id=self.current_user.id).execute()
+        return self.create_transfers([{'amount': amount, 'from_account': from_account,
+                                       'to_account': to_account, 'date': date,
+                                       'time': time, 'comments': comments}])
+
+    def insert_new(self, model, rows):
+        """
+        Insert rows whose content_hash is not in the table yet, return the
+        inserted ones. Must be called inside a transaction.
+        """
+        existed = set(hash_value for hash_value, in model
+                      .select(model.content_hash)
+                      .where(model.content_hash.in_([row['content_hash'] for row in rows]))
+                      .tuples())
+        rows = [row for row in rows if row['content_hash'] not in existed]
+        if not rows:
+            return rows
+        # only a duplicated content_hash is ignored, other errors are raised
+        # (INSERT IGNORE of MySQL would turn them into warnings)
+        query = model.insert_many(rows)
+        if is_sqlite():
+            query = query.on_conflict('nothing', conflict_target=[model.content_hash])
+        else:
+            # a row left unchanged by the update is not counted as affected
+            query = query.on_conflict(update={model.id: model.id})
+        inserted = query.as_rowcount().execute()
+        if inserted != len(rows):
+            # written by someone else in between, statistics would count it twice
+            raise IntegrityError("%d of %d %s rows were inserted concurrently." %
+                                 (len(rows) - inserted, len(rows), model._meta.table_name))
+        return rows
+
+    def insert_all(self, model, rows):
+        """
+        Insert rows without looking for duplicates, return them. Must be
+        called inside a transaction.
+        """
+        if is_sqlite():
+            # the search index is filled by id, see search.index_rows(); ids
+            # grow in the order of rows, RETURNING gives them in any order
+            query = model.insert_many(rows).returning(model.id).tuples()
+            for row, row_id in zip(rows, sorted(row_id for row_id, in query.execute())):
+                row['id'] = row_id
+        else:
+            model.insert_many(rows).execute()
+        return rows
+
+    def insert_rows(self, model, rows, occurrences):
+        """Rows of a statement (occurrences given) are deduplicated, others are all inserted."""
+        if occurrences is None:
+            return self.insert_all(model, rows)
+        return self.insert_new(model, rows)
+
+    def create_bills(self, bills, occurrences=None):
+        """
+        Insert many bills in one transaction. Every item is a dict with the
+        same keys as create_bill() arguments: amount, inout, account, date,
+        time, comments. Amounts are in yuan. Month statistics and balances
+        of the accounts are updated in the same transaction.
+
+        When occurrences is given, the bills are rows of a statement:
+        those already in database (same content hash) are skipped, so a
+        statement can be imported again safely. occurrences counts rows of
+        the statement written by earlier calls, see fingerprint.py. Without
+        it every bill is inserted, two identical bills entered by hand are
+        two bills. Return {'inserted', 'updated', 'skipped'} counts.
+        """
+        rows = [{'amount': to_cents(bill['amount']), 'inout_type': bill['inout'],
+                 'account_id': bill['account'].id, 'billing_date': bill['date'],
+                 'billing_time': bill['time'], 'comments': bill['comments'],
+                 'user_id': self.current_user.id} for bill in bills]
+        if not rows:
+            return {'inserted': 0, 'updated': 0, 'skipped': 0}
+        if occurrences is not None:
+            seen = assign_hashes(rows, bill_values, occurrences)
+        is_credit = {bill['account'].id: bill['account'].is_credit for bill in bills}
+        with db.atomic():
+            inserted = self.insert_rows(Bill, rows, occurrences)
+            search.index_rows(Bill, inserted)
+            deltas = {}
+            balances = {}
+            for row in inserted:
+                add_bill_delta(deltas, row['account_id'], row['billing_date'],
+                               row['inout_type'], row['amount'])
+                balances[row['account_id']] = balances.get(row['account_id'], 0) + \
+                    bill_balance_delta(row['inout_type'], row['amount'],
+                                       is_credit[row['account_id']])
+            self.apply_stat_deltas(deltas)
+            self.apply_balance_deltas(balances)
+            self.invalidate_checkpoints(deltas)
+            self.bump_versions(written_months(deltas, inserted))
+        if occurrences is not None:
+            merge_occurrences(occurrences, seen)
+        return {'inserted': len(inserted), 'updated': 0,
+                'skipped': len(rows) - len(inserted)}
+
+    def create_transfers(self, transfers, occurrences=None):
+        """
+        Insert many transfers in one transaction. Every item is a dict with
+        keys: amount (in yuan), from_account, to_account, date, time,
+        comments. Month statistics and balances of both accounts are updated
+        in the same transaction. Transfers of a statement already in
+        database are skipped like in create_bills(). Return {'inserted',
+        'updated', 'skipped'}.
+        """
+        rows = [{'amount': to_cents(transfer['amount']),
+                 'from_account_id': transfer['from_account'].id,
+                 'to_account_id': transfer['to_account'].id,
+                 'transfer_date': transfer['date'],
+                 'transfer_time': transfer['time'],
+                 'comments': transfer['comments'],
+                 'user_id': self.current_user.id} for transfer in transfers]
+        if not rows:
+            return {'inserted': 0, 'updated': 0, 'skipped': 0}
+        if occurrences is not None:
+            seen = assign_hashes(rows, transfer_values, occurrences)
+        is_credit = {}
+        for transfer in transfers:
+            for account in (transfer['from_account'], transfer['to_account']):
+                is_credit[account.id] = account.is_credit
+        with db.atomic():
+            inserted = self.insert_rows(Transfer, rows, occurrences)
+            search.index_rows(Transfer, inserted)
+            deltas = {}
+            balances = {}
+            for row in inserted:
+                add_transfer_delta(deltas, row['from_account_id'], row['to_account_id'],
+                                   row['transfer_date'], row['amount'])
+                from_id, to_id = row['from_account_id'], row['to_account_id']
+                balances[from_id] = balances.get(from_id, 0) - \
+                    balance_sign(is_credit[from_id]) * row['amount']
+                balances[to_id] = balances.get(to_id, 0) + \
+                    balance_sign(is_credit[to_id]) * row['amount']
+            self.apply_stat_deltas(deltas)
+            self.apply_balance_deltas(balances)
+            self.invalidate_checkpoints(deltas)
+            self.bump_versions(written_months(deltas, inserted))
+        if occurrences is not None:
+            merge_occurrences(occurrences, seen)
+        return {'inserted': len(inserted), 'updated': 0,
+                'skipped': len(rows) - len(inserted)}
+
+    def apply_stat_deltas(self, deltas):
+        """
+        Add deltas in cents ({(account_id, month_date): {field: delta}}) to the month
+        statistics, missing month items are created. Must be called inside
+        a transaction.
+        """
+        for (account_id, date), fields in deltas.items():
+            updated = (AccountStatMonth
+                       .update({getattr(AccountStatMonth, field):
+                                    getattr(AccountStatMonth, field) + delta
+                                for field, delta in fields.items()})
+                       .where(AccountStatMonth.account_id==account_id,
+                              AccountStatMonth.date==date)
+                       .execute())
+            if not updated:
+                AccountStatMonth.insert(date=date, account_id=account_id,
+                                        **fields).execute()
+
+    def apply_balance_deltas(self, balances):
+        """
+        Add deltas in cents ({account_id: delta}) to remain_balance of the accounts.
+        Must be called inside a transaction.
+        """
+        for account_id, delta in balances.items():
+            if not delta:
+                continue
+            (Account
+             .update(remain_balance=Account.remain_balance + delta)
+             .where(Account.id==account_id)
+             .execute())
+
+    def get_balance(self, account_id):
+        """Current balance of an account in yuan, read by primary key."""
+        return from_cents(Account.select(Account.remain_balance)
+                          .where(Account.id==account_id).scalar())
+
+    def invalidate_checkpoints(self, deltas):
+        """
+        Clear opening balances after the months touched by deltas
+        ({(account_id, month_date): ...}), in one UPDATE. Must be called
+        inside a transaction.
+        """
+        first = {}
+        for account_id, date in deltas:
+            first[account_id] = min(first.get(account_id, date), date)
+        if not first:
+            return 0
+        later = reduce(operator.or_, [(AccountStatMonth.account_id==account_id) &
+                                      (AccountStatMonth.date > date)
+                                      for account_id, date in first.items()])
+        return (AccountStatMonth
+                .update(opening_balance=None)
+                .where(later, AccountStatMonth.opening_balance.is_null(False))
+                .execute())
+
+    def movements(self, accounts, start=None, end=None):
+        """
+        Balance movements in cents of accounts ({account_id: Account}) by
+        month, from start to end dates (both included, None for no bound).
+        Return {(account_id, 'YYYY-MM'): delta}. Undated rows are left out.
+        """
+        moves = {}
+        def add(account_id, month, delta):
+            if month:
+                moves[account_id, month] = moves.get((account_id, month), 0) + delta
+
+        month = month_of(Bill.billing_date)
+        bills = (Bill
+                 .select(Bill.account_id, month, Bill.inout_type, fn.SUM(Bill.amount))
+                 .where(Bill.user_id==self.current_user.id,
+                        Bill.account_id.in_(list(accounts))))
+        if start:
+            bills = bills.where(Bill.billing_date >= start)
+        if end:
+            bills = bills.where(Bill.billing_date <= end)
+        for account_id, month, inout, amount in (bills
+                .group_by(Bill.account_id, month, Bill.inout_type).tuples()):
+            add(account_id, month, bill_balance_delta(inout, int(amount),
+                                                      accounts[account_id].is_credit))
+
+        month = month_of(Transfer.transfer_date)
+        for column, direction in ((Transfer.from_account_id, -1),
+                                  (Transfer.to_account_id, 1)):
+            transfers = (Transfer
+                         .select(column, month, fn.SUM(Transfer.amount))
+                         .where(column.in_(list(accounts))))
+            if start:
+                transfers = transfers.where(Transfer.transfer_date >= start)
+            if end:
+                transfers = transfers.where(Transfer.transfer_date <= end)
+            for account_id, month_text, amount in (transfers
+                    .group_by(column, month).tuples()):
+                add(account_id, month_text, direction * int(amount) *
+                    balance_sign(accounts[account_id].is_credit))
+        return moves
+
+    def refresh_checkpoints(self, accounts):
+        """
+        Compute the missing opening balances of accounts ({account_id:
+        Account}) from the last valid checkpoint before them, replaying
+        the months in between. Return the number of updated items.
+        """
+        stale = dict(AccountStatMonth
+                     .select(AccountStatMonth.account_id, fn.MIN(AccountStatMonth.date))
+                     .where(AccountStatMonth.account_id.in_(list(accounts)),
+                            AccountStatMonth.opening_balance.is_null())
+                     .group_by(AccountStatMonth.account_id)
+                     .tuples())
+        updated = 0
+        with db.atomic():
+            for account_id, first in stale.items():
+                base = (AccountStatMonth
+                        .select(AccountStatMonth.date, AccountStatMonth.opening_balance)
+                        .where(AccountStatMonth.account_id==account_id,
+                               AccountStatMonth.date < first,
+                               AccountStatMonth.opening_balance.is_null(False))
+                        .order_by(AccountStatMonth.date.desc())
+                        .first())
+                if base:
+                    start, balance = base.date, base.opening_balance
+                else:
+                    start, balance = None, accounts[account_id].init_balance
+                moves = sorted((month, delta) for (_, month), delta in
+                               self.movements({account_id: accounts[account_id]},
+                                              start=start).items())
+                items = (AccountStatMonth
+                         .select(AccountStatMonth.id, AccountStatMonth.date,
+                                 AccountStatMonth.opening_balance)
+                         .where(AccountStatMonth.account_id==account_id,
+                                AccountStatMonth.date >= first)
+                         .order_by(AccountStatMonth.date))
+                index = 0
+                for item in items:
+                    month = month_str(item.date)
+                    while index < len(moves) and moves[index][0] < month:
+                        balance += moves[index][1]
+                        index += 1
+                    if item.opening_balance != balance:
+                        (AccountStatMonth
+                         .update(opening_balance=balance)
+                         .where(AccountStatMonth.id==item.id)
+                         .execute())
+                        updated += 1
+        return updated
+
+    def balances_at(self, accounts, date):
+        """
+        Balances in cents of accounts ({account_id: Account}) at the end of
+        date: the latest checkpoint at or before it plus the movements
+        since. Return {account_id: balance}.
+        """
+        # init_balance and is_credit are read again, instances given by the
+        # caller may come from get_or_create() without column defaults
+        accounts = {account.id: account for account in
+                    Account.select(Account.id, Account.init_balance, Account.is_credit)
+                    .where(Account.id.in_(list(accounts)))}
+        self.refresh_checkpoints(accounts)
+        latest = (AccountStatMonth
+                  .select(AccountStatMonth.account_id,
+                          fn.MAX(AccountStatMonth.date).alias('date'))
+                  .where(AccountStatMonth.account_id.in_(list(accounts)),
+                         AccountStatMonth.date <= date,
+                         AccountStatMonth.opening_balance.is_null(False))
+                  .group_by(AccountStatMonth.account_id))
+        checkpoints = {account_id: (month_str(month), balance) for account_id, month, balance in
+                       AccountStatMonth
+                       .select(AccountStatMonth.account_id, AccountStatMonth.date,
+                               AccountStatMonth.opening_balance)
+                       .join(latest, on=((AccountStatMonth.account_id==latest.c.account_id) &
+                                         (AccountStatMonth.date==latest.c.date)))
+                       .tuples()}
+        balances = {account_id: account.init_balance
+                    for account_id, account in accounts.items()}
+        start = None
+        if len(checkpoints) == len(accounts):
+            start = min(month for month, balance in checkpoints.values()) + '-01'
+        for account_id, (month, balance) in checkpoints.items():
+            balances[account_id] = balance
+        for (account_id, month), delta in self.movements(accounts, start, date).items():
+            if account_id in checkpoints and month < checkpoints[account_id][0]:
+                continue
+            balances[account_id] += delta
+        return balances
+
+    def balance_at(self, account, date):
+        """
+        Balance of an account in yuan at the end of date ('YYYY-MM-DD'),
+        like remain_balance then. Undated bills and transfers are not
+        counted.
+        """
+        return from_cents(self.balances_at({account.id: account}, str(date))[account.id])
+
+    def net_worth_series(self, start_month, end_month=None):
+        """
+        Month end balances of all current user's accounts from start_month
+        to end_month (both 'YYYY-MM', included). Return a list of dicts
+        with keys month, assets, debts (balances of credit accounts) and
+        net_worth, in yuan. The result is cached.
+        """
+        if not end_month:
+            end_month = start_month
+        return self.cached_report('net_worth', (start_month, end_month),
+                                  lambda: self.compute_net_worth_series(start_month, end_month),
+                                  None, end_month + '-01')
+
+    def compute_net_worth_series(self, start_month, end_month):
+        accounts = {account.id: account for account in
+                    Account.select().where(Account.user_id==self.current_user.id)}
+        if not accounts:
+            return []
+        balances = self.balances_at(accounts, previous_day(start_month + '-01'))
+        moves = self.movements(accounts, start_month + '-01',
+                               previous_day(next_month(end_month)))
+        series = []
+        month = start_month
+        while month <= end_month:
+            for account_id in accounts:
+                balances[account_id] += moves.get((account_id, month), 0)
+            assets = sum(balance for account_id, balance in balances.items()
+                         if not accounts[account_id].is_credit)
+            debts = sum(balance for account_id, balance in balances.items()
+                        if accounts[account_id].is_credit)
+            series.append({'month': month, 'assets': from_cents(assets),
+                           'debts': from_cents(debts),
+                           'net_worth': from_cents(assets - debts)})
+            month = month_str(next_month(month))
+        return series
+
+    def reconcile_balances(self, fix=False):
+        """
+        Recompute balances of current user's accounts from init_balance and
+        every bill and transfer, and compare them with remain_balance.
+        Return a list of drifted accounts as dicts with keys account,
+        stored, expected and drift (in yuan). With fix set, the drifted
+        remain_balance are overwritten by the expected ones.
+        """
+        accounts = {account.id: account for account in
+                    Account.select().where(Account.user_id==self.current_user.id)}
+        expected = {account_id: account.init_balance
+                    for account_id, account in accounts.items()}
+
+        bills = (Bill
+                 .select(Bill.account_id, Bill.inout_type, fn.SUM(Bill.amount))
+                 .where(Bill.user_id==self.current_user.id)
+                 .group_by(Bill.account_id, Bill.inout_type)
+                 .tuples())
+        for account_id, inout, amount in bills:
+            expected[account_id] += bill_balance_delta(
+                    inout, int(amount), accounts[account_id].is_credit)
+
+        for column, direction in ((Transfer.from_account_id, -1),
+                                  (Transfer.to_account_id, 1)):
+            transfers = (Transfer
+                         .select(column, fn.SUM(Transfer.amount))
+                         .where(Transfer.user_id==self.current_user.id)
+                         .group_by(column)
+                         .tuples())
+            for account_id, amount in transfers:
+                expected[account_id] += direction * \
+                    balance_sign(accounts[account_id].is_credit) * int(amount)
+
+        drifts = []
+        for account_id, account in accounts.items():
+            drift = account.remain_balance - expected[account_id]
+            if not drift:
+                continue
+            drifts.append({'account': account,
+                           'stored': from_cents(account.remain_balance),
+                           'expected': from_cents(expected[account_id]),
+                           'drift': from_cents(drift)})
+            warning("Balance of account %s drifts: stored %s, expected %s." %
+                    (account.account_name, from_cents(account.remain_balance),
+                     from_cents(expected[account_id])))
+
+        if fix and drifts:
+            with db.atomic():
+                for item in drifts:
+                    (Account
+                     .update(remain_balance=to_cents(item['expected']))
+                     .where(Account.id==item['account'].id)
+                     .execute())
+                self.bump_versions([UNDATED_MONTH])
+            info("%d drifted balances are fixed." % len(drifts))
+
+        return drifts
+
+    def rebuild_stat_months(self, start_month, end_month=None):
+        """
+        Recompute normal_income, normal_outcome and transfer of current
+        user's month statistics from start_month to end_month (both
+        'YYYY-MM', included) from the raw bills and transfers. Other
+        statistic columns are kept as they are.
+        Return the number of rebuilt (account, month) items.
+        """
+        if not end_month:
+            end_month = start_month
+        start = start_month + '-01'
+        end = next_month(end_month)
+        accounts = Account.select(Account.id).where(Account.user_id==self.current_user.id)
+
+        deltas = {}
+        bills = (Bill
+                 .select(Bill.account_id, Bill.billing_date, Bill.inout_type,
+                         fn.SUM(Bill.amount))
+                 .where(Bill.user_id==self.current_user.id,
+                        Bill.billing_date >= start, Bill.billing_date < end)
+                 .group_by(Bill.account_id, Bill.billing_date, Bill.inout_type)
+                 .tuples())
+        transfers = (Transfer
+                     .select(Transfer.from_account_id, Transfer.to_account_id,
+                             Transfer.transfer_date, fn.SUM(Transfer.amount))
+                     .where(Transfer.user_id==self.current_user.id,
+                            Transfer.transfer_date >= start,
+                            Transfer.transfer_date < end)
+                     .group_by(Transfer.from_account_id, Transfer.to_account_id,
+                               Transfer.transfer_date)
+                     .tuples())
+
+        with db.atomic():
+            (AccountStatMonth
+             .update(normal_income=0, normal_outcome=0, transfer=0)
+             .where(AccountStatMonth.account_id.in_(accounts),
+                    AccountStatMonth.date >= start, AccountStatMonth.date < end)
+             .execute())
+            for account_id, date, inout, amount in bills:
+                add_bill_delta(deltas, account_id, date, inout, int(amount))
+            for from_id, to_id, date, amount in transfers:
+                add_transfer_delta(deltas, from_id, to_id, date, int(amount))
+            self.apply_stat_deltas(deltas)
+            months = []
+            month = start_month
+            while month <= end_month:
+                months.append(month + '-01')
+                month = month_str(next_month(month))
+            self.bump_versions(months)
+
+        info("Month statistics from %s to %s are rebuilt, %d items touched." %
+                (start_month, end_month, len(deltas)))
+        return len(deltas)
+
+    def create_account_stat_months(self, stats):
+        """
+        Upsert many month statistics in one transaction: new (account, month)
+        items are inserted, existing ones with other TYPED_STAT_FIELDS
+        values are overwritten and the others are skipped, all in one
+        INSERT statement. normal_income, normal_outcome and transfer of an
+        existing item are kept, bill and transfer writes maintain them.
+        Every item is a dict with keys: month, account and the statistic
+        columns. Return {'inserted', 'updated', 'skipped'} counts.
+        """
+        stats = list(stats)
+        counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+        if not stats:
+            return counts
+        dates = set(stat['month'] + '-01' for stat in stats)
+        account_ids = set(stat['account'].id for stat in stats)
+        typed = [getattr(AccountStatMonth, field) for field in TYPED_STAT_FIELDS]
+        with db.atomic():
+            existed = {(str(date), account_id): tuple(values) for date, account_id, *values in
+                       AccountStatMonth.select(AccountStatMonth.date,
+                                               AccountStatMonth.account_id, *typed)
+                       .where(AccountStatMonth.date.in_(list(dates)),
+                              AccountStatMonth.account_id.in_(list(account_ids)))
+                       .tuples()}
+            rows = {}
+            for stat in stats:
+                key = (stat['month'] + '-01', stat['account'].id)
+                values = tuple(to_cents(stat[field]) for field in STAT_FIELDS)
+                if key not in existed:
+                    counts['inserted'] += key not in rows
+                elif existed[key] == values[:len(TYPED_STAT_FIELDS)]:
+                    counts['skipped'] += 1
+                    continue
+                else:
+                    counts['updated'] += key not in rows
+                # the last item of an (account, month) wins
+                rows[key] = {'date': key[0], 'account_id': key[1],
+                             **dict(zip(STAT_FIELDS, values))}
+            if rows:
+                query = AccountStatMonth.insert_many(list(rows.values()))
+                if is_sqlite():
+                    query = query.on_conflict(conflict_target=[AccountStatMonth.account_id,
+                                                               AccountStatMonth.date],
+                                              preserve=typed)
+                else:
+                    query = query.on_conflict(preserve=typed)
+                query.execute()
+                self.bump_versions(date for date, account_id in rows)
+        counts['skipped'] += len(stats) - sum(counts.values())
+        return counts
+
+    def stat_report(self, start_month, end_month=None, by='account', all_users=False):
+        """
+        Sum up month statistics from start_month to end_month (both 'YYYY-MM',
+        included) in one query. Items are grouped by month and by 'account',
+        'group', 'user' or None (whole month). Only current user's accounts
+        are counted unless all_users is set.
+        Return a list of dicts with keys month, key, name and STAT_FIELDS
+        (in yuan). The result is cached.
+        """
+        if not end_month:
+            end_month = start_month
+        return self.cached_report('stat_report', (start_month, end_month, by),
+                                  lambda: self.compute_stat_report(start_month, end_month,
+                                                                   by, all_users),
+                                  start_month + '-01', end_month + '-01', all_users)
+
+    def compute_stat_report(self, start_month, end_month, by, all_users):
+        keys = {'account': (Account.id, Account.account_name),
+                'group': (AccountGroup.id, AccountGroup.account_group_name),
+                'user': (User.id, User.nickname),
+                None: ()}[by]
+
+        sums = [fn.SUM(getattr(AccountStatMonth, field)).alias(field)
+                for field in STAT_FIELDS]
+        query = (AccountStatMonth
+                 .select(AccountStatMonth.date, *keys, *sums)
+                 .join(Account))
+        if by == 'group':
+            query = query.join(AccountGroup)
+        elif by == 'user':
+            query = query.join(User)
+        query = query.where(AccountStatMonth.date.between(start_month + '-01',
+                                                          end_month + '-01'))
+        if not all_users:
+            query = query.where(Account.user_id==self.current_user.id)
+        query = (query.group_by(AccountStatMonth.date, *keys)
+                 .order_by(AccountStatMonth.date, *keys)
+                 .tuples())
+
+        report = []
+        for row in query:
+            item = {'month': month_str(row[0]),
+                    'key': row[1] if keys else None,
+                    'name': row[2] if keys else None}
+            item.update(zip(STAT_FIELDS, map(from_cents, row[1 + len(keys):])))
+            report.append(item)
+        return report
 
     def month_stat_sumup(self, month):
-        stat_months = AccountStatMonth.select().where(
-                AccountStatMonth.date==month+'-01')
+        report = self.stat_report(month, by=None,
+                                  all_users=self.current_user is None)
 
-        if not stat_months:
+        if not report:
             warning("No statistic item be found in %s month" % month)
             return
 
-        sumups = {'amount': 0.0, 'adjust': 0.0, 'interest_income': 0.0,
-                'invest_income': 0.0, 'normal_income': 0.0, 'normal_outcome': 0.0,
-                'transfer': 0.0}
-        for stat in stat_months:
-            sumups['amount'] += stat.amount
-            sumups['adjust'] += stat.adjust
-            sumups['interest_income'] += stat.interest_income
-            sumups['invest_income'] += stat.invest_income
-            sumups['normal_income'] += stat.normal_income
-            sumups['normal_outcome'] += stat.normal_outcome
-            sumups['transfer'] += stat.transfer
+        sumups = {field: report[0][field] for field in STAT_FIELDS}
 
         info("Statistic data in %s is:" % month)
         for k,v in sumups.items():
-            info("sumup %s: %f" % (k, v))
+            info("sumup %s: %s" % (k, v))
+
+        return sumups
 
     def account_stat_sumup(self, account_name, month):
         try:
@@ -208,24 +1157,25 @@ class DatabaseDriver():
             warning(err.args[0])
             return
 
-        stat_account = AccountStatMonth.select().where(
-                AccountStatMonth.account_id==account.id,
-                AccountStatMonth.date==month+'-01')
+        stat_account = self.cached_report(
+                'account_stat', (account.id, month),
+                lambda: (AccountStatMonth
+                         .select(*[fn.SUM(getattr(AccountStatMonth, field))
+                                   for field in STAT_FIELDS])
+                         .where(AccountStatMonth.account_id==account.id,
+                                AccountStatMonth.date==month+'-01')
+                         .tuples().first()),
+                month + '-01', month + '-01')
 
-        if not stat_account:
+        if not stat_account or stat_account[0] is None:
             warning("No statistic item be found of account %s" % account.account_name)
             return
 
-        reminde = 0.0
-        amount = 0.0
-        for stat in stat_account:
-            reminde += stat.adjust + stat.interest_income + stat.invest_income + \
-                      stat.normal_income + stat.normal_outcome + stat.transfer
-            amount += stat.amount
-
-        info("Amount remaind of %s in %s is: %f" % (account_name, month, reminde))
-        info("Amount amount of %s in %s is: %f" % (account_name, month, amount))
-
-
+        sumups = dict(zip(STAT_FIELDS, map(int, stat_account)))
+        amount = from_cents(sumups['amount'])
+        reminde = from_cents(sum(sumups[field] for field in STAT_FIELDS[1:]))
 
+        info("Amount remaind of %s in %s is: %s" % (account_name, month, reminde))
+        info("Amount amount of %s in %s is: %s" % (account_name, month, amount))
 
+        return {'remain': reminde, 'amount': amount}
@@ -4,6 +4,9 @@ import datetime
 from utils import info
 
 from app import db
+from money import MoneyField
+
+# every money column is integer cents (分), see money.py
 
 class BaseModel(Model):
     class Meta:
@@ -22,17 +25,23 @@ class AccountGroup(BaseModel):
 class Account(BaseModel):
     account_name = CharField(max_length=30)
     is_credit = BooleanField(constraints=[SQL("DEFAULT False")])
-    init_balance = FloatField(constraints=[Check('init_balance >= 0.0'),
-                                             SQL("DEFAULT 0.0")])
-    remain_balance = FloatField(constraints=[Check('remain_balance >= 0.0'),
-                                               SQL("DEFAULT 0.0")])
+    init_balance = MoneyField(constraints=[Check('init_balance >= 0'),
+                                             SQL("DEFAULT 0")])
+    # running balance maintained by DatabaseDriver, money owed for credit
+    # accounts, so it may go below zero on overdraft
+    remain_balance = MoneyField(constraints=[SQL("DEFAULT 0")])
     currency = CharField(constraints=[Check("currency='RMB' OR currency='Dollar'"),
                                       SQL("DEFAULT 'RMB'")])
     user_id = ForeignKeyField(User, backref="accounts")
     account_group_id = ForeignKeyField(AccountGroup, backref="accounts")
 
+    class Meta:
+        indexes = (
+            (('account_name', 'user_id'), False),
+        )
+
 class Bill(BaseModel):
-    amount = FloatField(constraints=[Check("amount >= 0.0"), SQL("DEFAULT 0.0")])
+    amount = MoneyField(constraints=[Check("amount >= 0"), SQL("DEFAULT 0")])
     inout_type = CharField(max_length=10,
                            constraints=[Check("inout_type='支出' OR inout_type='收入'"),
                                         SQL("DEFAULT '支出'")])
@@ -43,35 +52,75 @@ class Bill(BaseModel):
     comments = CharField(null=True, max_length=50)
     account_id = ForeignKeyField(Account, backref="bills")
     user_id = ForeignKeyField(User, backref="bills")
+    # sha256 of the content, see fingerprint.py
+    content_hash = CharField(null=True, max_length=64)
+
+    class Meta:
+        indexes = (
+            (('user_id', 'account_id', 'billing_date'), False),
+            (('user_id', 'billing_date'), False),
+            (('content_hash',), True),
+        )
 
 class Transfer(BaseModel):
-    amount = FloatField(constraints=[Check("amount >= 0.0"), SQL("DEFAULT 0.0")])
+    amount = MoneyField(constraints=[Check("amount >= 0"), SQL("DEFAULT 0")])
     created_datetime = DateTimeField(null=True,
                                      constraints=[SQL("DEFAULT CURRENT_TIMESTAMP")])
     transfer_date = DateField(null=True)
     transfer_time = TimeField(null=True)
     comments = CharField(null=True, max_length=50)
-    from_account_id = ForeignKeyField(Account, backref="bills")
-    to_account_id = ForeignKeyField(Account, backref="bills")
-    user_id = ForeignKeyField(User, backref="bills")
+    from_account_id = ForeignKeyField(Account, backref="transfers_out")
+    to_account_id = ForeignKeyField(Account, backref="transfers_in")
+    user_id = ForeignKeyField(User, backref="transfers")
+    # sha256 of the content, see fingerprint.py
+    content_hash = CharField(null=True, max_length=64)
+
+    class Meta:
+        indexes = (
+            (('from_account_id', 'transfer_date'), False),
+            (('to_account_id', 'transfer_date'), False),
+            (('user_id', 'transfer_date'), False),
+            (('content_hash',), True),
+        )
 
 class AccountStatMonth(BaseModel):
     date = DateField()
     account_id = ForeignKeyField(Account, backref="AccountStatMonths")
-    amount = FloatField(constraints=[ SQL("DEFAULT 0.0")],
+    amount = MoneyField(constraints=[ SQL("DEFAULT 0")],
                         help_text="每月余额")
-    adjust = FloatField(constraints=[SQL("DEFAULT 0.0")],
+    adjust = MoneyField(constraints=[SQL("DEFAULT 0")],
                         help_text="每月月初调整额度")
-    interest_income = FloatField(constraints=[SQL("DEFAULT 0.0")],
+    interest_income = MoneyField(constraints=[SQL("DEFAULT 0")],
                                  help_text="每月利息收入")
-    invest_income = FloatField(constraints=[SQL("DEFAULT 0.0")],
+    invest_income = MoneyField(constraints=[SQL("DEFAULT 0")],
                                help_text="每月投资收入")
-    normal_income = FloatField(constraints=[Check("normal_income >= 0.0"),
-                                            SQL("DEFAULT 0.0")],
+    normal_income = MoneyField(constraints=[Check("normal_income >= 0"),
+                                            SQL("DEFAULT 0")],
                                help_text="每月普通收入，如工资")
-    normal_outcome = FloatField(constraints=[Check("normal_outcome >= 0.0"),
-                                             SQL("DEFAULT 0.0")],
+    normal_outcome = MoneyField(constraints=[Check("normal_outcome >= 0"),
+                                             SQL("DEFAULT 0")],
                                 help_text="每月普通支出")
-    transfer = FloatField(constraints=[SQL("DEFAULT 0.0")],
+    transfer = MoneyField(constraints=[SQL("DEFAULT 0")],
                           help_text="每月账户间转账额度")
+    # balance checkpoint maintained by DatabaseDriver, null when a backdated
+    # bill or transfer made it stale
+    opening_balance = MoneyField(null=True, help_text="月初余额")
+
+    class Meta:
+        indexes = (
+            (('account_id', 'date'), True),
+        )
+
+class WriteVersion(BaseModel):
+    """Counter of writes per user and month, cached reports are checked against it."""
+    user_id = ForeignKeyField(User, backref="write_versions")
+    month = DateField()
+    version = IntegerField(constraints=[SQL("DEFAULT 0")])
+
+    class Meta:
+        indexes = (
+            (('user_id', 'month'), True),
+        )
 
+class SchemaVersion(BaseModel):
+    version = IntegerField(help_text="已应用的数据库结构版本")
@@ -0,0 +1,239 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for export a user's ledger. Rows are streamed from the
+database (server side cursor on MySQL) and written as they come, either as
+CSV files in the same layout the importer reads, or as a columnar binary
+directory of .npy files which analytics.load_export() memory-maps.
+"""
+import argparse
+import csv
+import json
+import os
+import numpy as np
+from utils import info, error
+
+from dbmodel import Account, AccountGroup, AccountStatMonth, Bill, Transfer
+from dbdriver import DatabaseDriver, STAT_FIELDS, stream, month_str
+from money import from_cents
+from app import db
+
+KINDS = ('accounts', 'bills', 'transfers', 'stats')
+
+# rows converted to arrays at a time in binary export
+CHUNK_SIZE = 65536
+
+BILL_COLUMNS = (('id', 'i8'), ('amount', 'i8'), ('income', '?'),
+                ('date', 'i8'), ('account', 'i8'))
+TRANSFER_COLUMNS = (('id', 'i8'), ('amount', 'i8'), ('date', 'i8'),
+                    ('from_account', 'i8'), ('to_account', 'i8'))
+
+class Exporter():
+    def __init__(self, driver, start_date=None, end_date=None):
+        self.driver = driver
+        self.start_date = start_date
+        self.end_date = end_date
+
+    @property
+    def nickname(self):
+        return self.driver.get_user().nickname
+
+    def accounts_query(self):
+        return (Account
+                .select(Account.account_name, Account.is_credit, Account.init_balance,
+                        Account.remain_balance, Account.currency,
+                        AccountGroup.account_group_name)
+                .join(AccountGroup)
+                .where(Account.user_id==self.driver.get_user().id)
+                .order_by(Account.id))
+
+    def bills_query(self):
+        return (self.driver.bills_query(start_date=self.start_date, end_date=self.end_date)
+                .join(Account, on=(Bill.account_id==Account.id)))
+
+    def transfers_query(self):
+        from_account = Account.alias()
+        to_account = Account.alias()
+        return (self.driver.transfers_query(start_date=self.start_date,
+                                            end_date=self.end_date)
+                .join(from_account, on=(Transfer.from_account_id==from_account.id))
+                .switch(Transfer)
+                .join(to_account, on=(Transfer.to_account_id==to_account.id))
+                .select(Transfer.amount, Transfer.transfer_date, Transfer.transfer_time,
+                        Transfer.comments, from_account.account_name,
+                        to_account.account_name)
+                .order_by(Transfer.transfer_date, Transfer.id))
+
+    def stats_query(self):
+        query = (AccountStatMonth
+                 .select(AccountStatMonth.date, Account.account_name,
+                         *[getattr(AccountStatMonth, field) for field in STAT_FIELDS])
+                 .join(Account)
+                 .where(Account.user_id==self.driver.get_user().id))
+        if self.start_date:
+            query = query.where(AccountStatMonth.date >= month_str(self.start_date) + '-01')
+        if self.end_date:
+            query = query.where(AccountStatMonth.date <= self.end_date)
+        return query.order_by(AccountStatMonth.date, Account.id)
+
+    def csv_rows(self, kind):
+        """Header and streamed rows of a kind, in the importer CSV layout."""
+        nickname = self.nickname
+        if kind == 'accounts':
+            header = ('name', 'is_credit', 'init_balance', 'remain_balance',
+                      'currency', 'group', 'user')
+            rows = ((name, is_credit, from_cents(init), from_cents(remain),
+                     currency, group, nickname)
+                    for name, is_credit, init, remain, currency, group
+                    in stream(self.accounts_query().tuples()))
+        elif kind == 'bills':
+            header = ('amount', 'inout', 'account', 'billing_date', 'billing_time',
+                      'comments', 'book', 'user')
+            query = (self.bills_query()
+                     .select(Bill.amount, Bill.inout_type, Account.account_name,
+                             Bill.billing_date, Bill.billing_time, Bill.comments)
+                     .order_by(Bill.billing_date, Bill.id))
+            rows = ((from_cents(amount), inout, account, date, time, comments, '', nickname)
+                    for amount, inout, account, date, time, comments
+                    in stream(query.tuples()))
+        elif kind == 'transfers':
+            header = ('amount', 'transfer_date', 'transfer_time', 'comments',
+                      'from_account', 'to_account', 'book', 'user')
+            rows = ((from_cents(amount), date, time, comments, from_name, to_name,
+                     '', nickname)
+                    for amount, date, time, comments, from_name, to_name
+                    in stream(self.transfers_query().tuples()))
+        else:
+            header = ('month', 'account') + STAT_FIELDS
+            rows = ((month_str(row[0]), row[1]) + tuple(map(from_cents, row[2:]))
+                    for row in stream(self.stats_query().tuples()))
+        return header, rows
+
+    def export_csv(self, directory, kinds=KINDS):
+        """Write <kind>.csv files into directory. Return {kind: row count}."""
+        os.makedirs(directory, exist_ok=True)
+        counts = {}
+        with db.atomic():
+            for kind in kinds:
+                header, rows = self.csv_rows(kind)
+                path = os.path.join(directory, '%s.csv' % kind)
+                with open(path, 'w', encoding='utf-8', newline='') as csv_file:
+                    writer = csv.writer(csv_file)
+                    writer.writerow(header)
+                    count = 0
+                    for row in rows:
+                        writer.writerow(row)
+                        count += 1
+                counts[kind] = count
+                info("%d %s exported to %s." % (count, kind, path))
+        return counts
+
+    def binary_columns(self, kind):
+        """Columns, row count and streamed rows of bills or transfers."""
+        if kind == 'bills':
+            query = (self.driver.bills_query(start_date=self.start_date,
+                                             end_date=self.end_date)
+                     .where(Bill.billing_date.is_null(False)))
+            count = query.count()
+            query = (query.select(Bill.id, Bill.amount, Bill.inout_type,
+                                  Bill.billing_date, Bill.account_id)
+                     .order_by(Bill.billing_date, Bill.id).tuples())
+            rows = ((bill_id, amount, inout == '收入', date.toordinal(), account_id)
+                    for bill_id, amount, inout, date, account_id in stream(query))
+            return BILL_COLUMNS, count, rows
+        query = (self.driver.transfers_query(start_date=self.start_date,
+                                             end_date=self.end_date)
+                 .where(Transfer.transfer_date.is_null(False)))
+        count = query.count()
+        query = (query.select(Transfer.id, Transfer.amount, Transfer.transfer_date,
+                              Transfer.from_account_id, Transfer.to_account_id)
+                 .order_by(Transfer.transfer_date, Transfer.id).tuples())
+        rows = ((transfer_id, amount, date.toordinal(), from_id, to_id)
+                for transfer_id, amount, date, from_id, to_id in stream(query))
+        return TRANSFER_COLUMNS, count, rows
+
+    def export_binary(self, directory, kinds=('bills', 'transfers')):
+        """
+        Write <kind>/<column>.npy files and meta.json into directory. Money
+        is integer cents and dates are date.toordinal() days, the same
+        columns analytics.Ledger takes. Return {kind: row count}.
+        """
+        os.makedirs(directory, exist_ok=True)
+        meta = {'user': self.nickname, 'start_date': self.start_date,
+                'end_date': self.end_date, 'kinds': {},
+                'accounts': {account.id: account.account_name
+                             for account in self.driver.get_account_map().values()}}
+        with db.atomic():
+            for kind in kinds:
+                columns, count, rows = self.binary_columns(kind)
+                os.makedirs(os.path.join(directory, kind), exist_ok=True)
+                paths = [os.path.join(directory, kind, name + '.npy')
+                         for name, dtype in columns]
+                if not count:
+                    # an empty array can not be memory-mapped
+                    for path, (name, dtype) in zip(paths, columns):
+                        np.save(path, np.empty(0, dtype=dtype))
+                    meta['kinds'][kind] = {'rows': 0,
+                                           'columns': [name for name, dtype in columns]}
+                    continue
+                arrays = [np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                                    shape=(count,))
+                          for path, (name, dtype) in zip(paths, columns)]
+                written = 0
+                chunk = []
+                for row in rows:
+                    chunk.append(row)
+                    if len(chunk) >= CHUNK_SIZE:
+                        written = write_chunk(arrays, chunk, written)
+                        chunk = []
+                written = write_chunk(arrays, chunk, written)
+                for array in arrays:
+                    array.flush()
+                meta['kinds'][kind] = {'rows': written,
+                                       'columns': [name for name, dtype in columns]}
+                info("%d %s exported to %s." % (written, kind,
+                                                os.path.join(directory, kind)))
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file, ensure_ascii=False, indent=2)
+        return {kind: item['rows'] for kind, item in meta['kinds'].items()}
+
+    def export(self, directory, format='csv', kinds=None):
+        """Export kinds (all by default) as 'csv' or 'npy', see export_csv()/export_binary()."""
+        if format == 'csv':
+            return self.export_csv(directory, kinds or KINDS)
+        return self.export_binary(directory, [kind for kind in kinds or KINDS
+                                              if kind in ('bills', 'transfers')])
+
+def write_chunk(arrays, chunk, offset):
+    if not chunk:
+        return offset
+    end = min(offset + len(chunk), len(arrays[0]))
+    columns = list(zip(*chunk[:end - offset]))
+    for array, column in zip(arrays, columns):
+        array[offset:end] = column
+    return end
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a Finanse ledger.")
+    parser.add_argument('--email', required=True, help="login email of the owner")
+    parser.add_argument('--password', required=True, help="login password of the owner")
+    parser.add_argument('--start', help="first date, YYYY-MM-DD")
+    parser.add_argument('--end', help="last date, YYYY-MM-DD")
+    parser.add_argument('--format', choices=('csv', 'npy'), default='csv')
+    parser.add_argument('output', help="output directory")
+    parser.add_argument('kinds', nargs='*',
+                        help="what to export among %s, all by default" % ", ".join(KINDS))
+    args = parser.parse_args(argv)
+    for kind in args.kinds:
+        if kind not in KINDS:
+            parser.error("unknown kind %s" % kind)
+
+    driver = DatabaseDriver()
+    if not driver.authenticate(args.email, args.password):
+        error("Login failed for %s." % args.email)
+        return 1
+
+    Exporter(driver, args.start, args.end).export(args.output, args.format, args.kinds)
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
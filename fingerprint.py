@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for compute content hashes of bills and transfers. The
+hash is made of the row's content and its occurrence, i.e. how many rows
+with the same content came before it in the same statement, so reloading a
+statement gives the same hashes while two identical purchases on a
+statement are still two bills.
+"""
+import hashlib
+
+HASH_LENGTH = 64
+
+def text(value):
+    return '' if value is None else str(value)
+
+def content_hash(values, occurrence=0):
+    data = "\x1f".join([text(value) for value in values] + [str(occurrence)])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def bill_values(row):
+    """Content of a bill row, keyed like Bill columns, amount in cents."""
+    return (row['user_id'], row['account_id'], row['inout_type'], row['amount'],
+            text(row['billing_date']), text(row['billing_time']), row['comments'] or None)
+
+def transfer_values(row):
+    """Content of a transfer row, keyed like Transfer columns, amount in cents."""
+    return (row['user_id'], row['from_account_id'], row['to_account_id'], row['amount'],
+            text(row['transfer_date']), text(row['transfer_time']),
+            row['comments'] or None)
+
+def assign_hashes(rows, values, occurrences=None):
+    """
+    Set 'content_hash' of rows. occurrences ({values: count}) carries the
+    counts of rows seen before, across batches of one statement; it is not
+    updated here, so a failed batch can be retried, merge the returned
+    counts after the batch is written.
+    """
+    before = occurrences or {}
+    seen = {}
+    for row in rows:
+        key = values(row)
+        count = seen.get(key, 0)
+        row['content_hash'] = content_hash(key, before.get(key, 0) + count)
+        seen[key] = count + 1
+    return seen
+
+def merge_occurrences(occurrences, seen):
+    """Add counts returned by assign_hashes() to occurrences."""
+    for key, count in seen.items():
+        occurrences[key] = occurrences.get(key, 0) + count
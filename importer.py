@@ -0,0 +1,265 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for import bills, transfers and month statistics from CSV
+files in batches. Rows are streamed from the file, account names are resolved
+with one query up front and every batch is written with insert_many in one
+transaction. Rows already imported are skipped (bills and transfers) or
+updated (month statistics), so importing a file again is safe.
+"""
+import argparse
+import csv
+import time as timer
+from datetime import datetime
+from decimal import Decimal
+from utils import info, warning, error
+
+from dbdriver import DatabaseDriver, STAT_FIELDS
+
+class RejectRow(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+    pass
+
+class ImportResult():
+    def __init__(self, kind, filename):
+        self.kind = kind
+        self.filename = filename
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.rejects = []
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return (self.inserted + self.updated + self.skipped + len(self.rejects)) / self.elapsed
+
+    def reject(self, line, reason):
+        self.rejects.append((line, reason))
+
+    def report(self):
+        info("Import %s from %s: %d inserted, %d updated, %d skipped, %d rejected "
+             "in %.3fs (%.1f rows/s)" %
+                (self.kind, self.filename, self.inserted, self.updated, self.skipped,
+                 len(self.rejects), self.elapsed, self.rows_per_second))
+        for line, reason in self.rejects:
+            warning("Line %d rejected: %s" % (line, reason))
+
+def parse_amount(value):
+    try:
+        amount = Decimal(value)
+    except (TypeError, ArithmeticError):
+        raise RejectRow("Invalid amount %r." % value)
+    if not amount.is_finite():
+        raise RejectRow("Invalid amount %r." % value)
+    return amount
+
+def parse_date(value):
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise RejectRow("Invalid date %r." % value)
+    return value
+
+def parse_time(value):
+    if not value:
+        return None
+    try:
+        datetime.strptime(value, '%H:%M:%S')
+    except (TypeError, ValueError):
+        raise RejectRow("Invalid time %r." % value)
+    return value
+
+def parse_month(value):
+    try:
+        datetime.strptime(value, '%Y-%m')
+    except (TypeError, ValueError):
+        raise RejectRow("Invalid month %r." % value)
+    return value
+
+def read_bill(item):
+    """Validate a bill row, accounts are left as names."""
+    if item['inout'] not in ('支出', '收入'):
+        raise RejectRow("Invalid inout type %r." % item['inout'])
+    return {'amount': parse_amount(item['amount']),
+            'inout': item['inout'],
+            'account': item['account'],
+            'date': parse_date(item['billing_date']),
+            'time': parse_time(item['billing_time']),
+            'comments': item['comments'] or None}
+
+def read_transfer(item):
+    return {'amount': parse_amount(item['amount']),
+            'from_account': item['from_account'],
+            'to_account': item['to_account'],
+            'date': parse_date(item['transfer_date']),
+            'time': parse_time(item['transfer_time']),
+            'comments': item['comments'] or None}
+
+def read_month_stat(item):
+    stat = {'month': parse_month(item['month']),
+            'account': item['account']}
+    for column in STAT_FIELDS:
+        stat[column] = parse_amount(item[column])
+    return stat
+
+# kind: (row reader, keys of account names in its rows)
+READERS = {
+    'bills': (read_bill, ('account',)),
+    'transfers': (read_transfer, ('from_account', 'to_account')),
+    'stats': (read_month_stat, ('account',)),
+}
+
+def read_rows(filename, parse, result):
+    """
+    Yield (line, row) parsed from a CSV file, rows refused by parse are
+    recorded in result.
+    """
+    with open(filename, 'r', encoding='utf-8', newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+        # header is line 1
+        for line, item in enumerate(reader, start=2):
+            try:
+                yield line, parse(item)
+            except RejectRow as err:
+                result.reject(line, err.message)
+            except KeyError as err:
+                result.reject(line, "Missing column %s." % err)
+
+class Importer():
+    def __init__(self, driver, batch_size=500):
+        self.driver = driver
+        self.batch_size = batch_size
+        self.accounts = None
+
+    def resolve_account(self, name):
+        if self.accounts is None:
+            self.accounts = self.driver.get_account_map()
+        try:
+            return self.accounts[name]
+        except KeyError:
+            raise RejectRow("Not find account %s." % name)
+
+    def resolve(self, kind, row):
+        """Replace account names of a row read by READERS[kind] with accounts."""
+        for key in READERS[kind][1]:
+            row[key] = self.resolve_account(row[key])
+        return row
+
+    def check_user(self, item):
+        user = item.get('user')
+        if user is not None and user != self.driver.get_user().nickname:
+            raise RejectRow("Row's user is %s, not you." % user)
+
+    def parse_bill(self, item):
+        self.check_user(item)
+        return self.resolve('bills', read_bill(item))
+
+    def parse_transfer(self, item):
+        self.check_user(item)
+        return self.resolve('transfers', read_transfer(item))
+
+    def parse_month_stat(self, item):
+        return self.resolve('stats', read_month_stat(item))
+
+    def writer(self, kind):
+        """The write function of a kind, see run()."""
+        if kind == 'bills':
+            return self.driver.create_bills
+        if kind == 'transfers':
+            return self.driver.create_transfers
+        return lambda stats, occurrences: self.driver.create_account_stat_months(stats)
+
+    def write_batch(self, write, batch, result):
+        """
+        Write one batch, if the whole batch is refused by database, retry row
+        by row to find out the rejected rows.
+        """
+        try:
+            counts = [write([row for line, row in batch])]
+        except Exception as err:
+            warning("Batch write failed (%s), retry row by row." % err)
+            counts = []
+            for line, row in batch:
+                try:
+                    counts.append(write([row]))
+                except Exception as row_err:
+                    result.reject(line, str(row_err))
+        for item in counts:
+            result.inserted += item['inserted']
+            result.updated += item['updated']
+            result.skipped += item['skipped']
+
+    def run(self, kind, filename, parse, write):
+        """
+        Parse and write a file batch by batch. write takes a list of parsed
+        rows and the occurrence counts of the file, see fingerprint.py.
+        """
+        # identical rows seen in earlier batches of this file
+        occurrences = {}
+        result = ImportResult(kind, filename)
+        start = timer.perf_counter()
+        batch = []
+        for line, row in read_rows(filename, parse, result):
+            batch.append((line, row))
+            if len(batch) >= self.batch_size:
+                self.write_batch(lambda rows: write(rows, occurrences), batch, result)
+                batch = []
+        if batch:
+            self.write_batch(lambda rows: write(rows, occurrences), batch, result)
+        result.elapsed = timer.perf_counter() - start
+        return result
+
+    def import_bills(self, filename):
+        return self.run('bills', filename, self.parse_bill, self.writer('bills'))
+
+    def import_transfers(self, filename):
+        return self.run('transfers', filename, self.parse_transfer, self.writer('transfers'))
+
+    def import_month_stats(self, filename):
+        return self.run('month statistics', filename, self.parse_month_stat,
+                        self.writer('stats'))
+
+    def import_files(self, kind, filenames):
+        """
+        Import files of a kind ('bills', 'transfers' or 'stats') and report
+        them. Return True if all of them are read without rejected rows.
+        """
+        imports = {'bills': self.import_bills,
+                   'transfers': self.import_transfers,
+                   'stats': self.import_month_stats}
+        succeeded = True
+        for filename in filenames:
+            try:
+                result = imports[kind](filename)
+            except OSError as err:
+                error("CSV file %s read failed: %s" % (filename, err))
+                succeeded = False
+                continue
+            result.report()
+            succeeded = succeeded and not result.rejects
+        return succeeded
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import CSV files into Finanse database.")
+    parser.add_argument('--email', required=True, help="login email of the owner")
+    parser.add_argument('--password', required=True, help="login password of the owner")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="rows written in one transaction")
+    parser.add_argument('kind', choices=('bills', 'transfers', 'stats'))
+    parser.add_argument('files', nargs='+', help="CSV files to import")
+    args = parser.parse_args(argv)
+
+    driver = DatabaseDriver()
+    if not driver.authenticate(args.email, args.password):
+        error("Login failed for %s." % args.email)
+        return 1
+
+    importer = Importer(driver, batch_size=args.batch_size)
+    return 0 if importer.import_files(args.kind, args.files) else 1
+
+if __name__ == "__main__":
+    exit(main())
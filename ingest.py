@@ -0,0 +1,351 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for ingest many CSV files of several users in parallel.
+Files are read and validated by a process pool, then their rows are split
+into shards which are written through a bounded number of database
+connections, one thread per connection.
+
+A shard holds the accounts of one user linked by transfers, all rows of an
+account go to the same shard and are written in the order of the files and
+of their lines. So every account sees its bills, transfers and month
+statistics in the same order as importing the files one by one, and
+repeated rows are counted the same (see fingerprint.py). Every writer
+thread keeps its own DatabaseDriver for each user instead of switching
+current_user of a shared one.
+
+Rows are owned by the user whose nickname is in their user column, or by
+the default user. The kind of a file is found from its header.
+
+SQLite takes one writer at a time (and an in-memory database belongs to
+one connection), so it is written from the calling thread; files are still
+read in parallel.
+"""
+import csv
+import os
+import queue
+import threading
+import time as timer
+from concurrent.futures import ProcessPoolExecutor
+from utils import info, warning, error
+
+from dbmodel import User
+from app import db, is_sqlite
+from dbdriver import DatabaseDriver
+from importer import Importer, ImportResult, RejectRow, READERS, read_rows
+
+# kind of a file by a column of its header, checked in order
+KIND_COLUMNS = (('transfers', 'from_account'), ('bills', 'inout'), ('stats', 'month'))
+
+# names of the kinds in reports, like Importer uses
+KIND_NAMES = {'bills': 'bills', 'transfers': 'transfers', 'stats': 'month statistics'}
+
+# seconds between progress reports
+PROGRESS_INTERVAL = 5.0
+
+def detect_kind(filename):
+    with open(filename, 'r', encoding='utf-8', newline='') as csv_file:
+        header = next(csv.reader(csv_file), [])
+    for kind, column in KIND_COLUMNS:
+        if column in header:
+            return kind
+    return None
+
+def collect_files(paths):
+    """
+    CSV files of paths in order, directories are walked in name order.
+    Files of a directory with no known kind (like accounts.csv) are skipped.
+    """
+    filenames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            filenames.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                if not name.lower().endswith('.csv'):
+                    continue
+                filename = os.path.join(root, name)
+                try:
+                    known = detect_kind(filename) is not None
+                except OSError:
+                    # reported when the file is read
+                    known = True
+                if not known:
+                    warning("Skip %s, unknown kind of CSV file." % filename)
+                    continue
+                filenames.append(filename)
+    return filenames
+
+class ParsedFile():
+    def __init__(self, filename, kind):
+        self.filename = filename
+        self.kind = kind
+        # (line, nickname of the user column or None, row)
+        self.rows = []
+        self.result = ImportResult(KIND_NAMES.get(kind, kind), filename)
+        self.error = None
+
+def parse_file(filename):
+    """Read and validate a file, run in the process pool."""
+    try:
+        kind = detect_kind(filename)
+        parsed = ParsedFile(filename, kind)
+        if kind is None:
+            parsed.error = "Unknown kind of CSV file, no %s column." % \
+                " or ".join(column for kind, column in KIND_COLUMNS)
+            return parsed
+        start = timer.perf_counter()
+        read = READERS[kind][0]
+        parse = lambda item: (item.get('user') or None, read(item))
+        parsed.rows = [(line, user, row) for line, (user, row)
+                       in read_rows(filename, parse, parsed.result)]
+        parsed.result.elapsed = timer.perf_counter() - start
+    except OSError as err:
+        parsed = ParsedFile(filename, None)
+        parsed.error = "CSV file read failed: %s" % err
+    return parsed
+
+def find(parents, key):
+    """Root of key in a union-find forest."""
+    while parents.setdefault(key, key) != key:
+        parents[key] = parents[parents[key]]
+        key = parents[key]
+    return key
+
+def union(parents, keys):
+    roots = [find(parents, key) for key in keys]
+    for root in roots[1:]:
+        parents[root] = roots[0]
+    return roots[0]
+
+class Shard():
+    def __init__(self, user):
+        self.user = user
+        # file index: [(line, row)] in line order
+        self.parts = {}
+        self.rows = 0
+
+    def add(self, index, line, row):
+        self.parts.setdefault(index, []).append((line, row))
+        self.rows += 1
+
+class Progress():
+    """Rows written so far, reported every interval seconds. Thread safe."""
+    def __init__(self, total, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.lock = threading.Lock()
+        self.start = timer.perf_counter()
+        self.reported = self.start
+
+    def rows_per_second(self):
+        elapsed = timer.perf_counter() - self.start
+        return self.done / elapsed if elapsed else 0.0
+
+    def add(self, rows):
+        with self.lock:
+            self.done += rows
+            now = timer.perf_counter()
+            if now - self.reported < self.interval:
+                return
+            self.reported = now
+            info("Ingested %d of %d rows (%.0f%%), %.1f rows/s" %
+                    (self.done, self.total, 100.0 * self.done / (self.total or 1),
+                     self.rows_per_second()))
+
+class Ingestor():
+    def __init__(self, default_user=None, processes=None, connections=None,
+                 batch_size=500, progress_interval=PROGRESS_INTERVAL):
+        self.default_user = default_user
+        self.processes = processes or os.cpu_count() or 1
+        # None to use every free connection of the pool
+        self.connections = connections
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.results = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def parse_files(self, filenames):
+        if self.processes <= 1 or len(filenames) <= 1:
+            return [parse_file(filename) for filename in filenames]
+        with ProcessPoolExecutor(max_workers=min(self.processes, len(filenames))) as pool:
+            return list(pool.map(parse_file, filenames))
+
+    def find_users(self, files):
+        """{nickname: user} of the user columns, ambiguous nicknames map to None."""
+        nicknames = set(user for parsed in files for line, user, row in parsed.rows if user)
+        users = {}
+        if nicknames:
+            for user in User.select().where(User.nickname.in_(list(nicknames))):
+                users[user.nickname] = None if user.nickname in users else user
+        return users
+
+    def make_shards(self, files):
+        """
+        Split rows of all files into shards of connected accounts, rows
+        without a known user are rejected.
+        """
+        users = self.find_users(files)
+        parents = {}
+        owners = {}
+        routed = []
+        for index, parsed in enumerate(files):
+            accounts = READERS[parsed.kind][1] if parsed.kind else ()
+            for line, nickname, row in parsed.rows:
+                user = users.get(nickname) if nickname else self.default_user
+                if user is None:
+                    if nickname is None:
+                        reason = "Row has no user and no default user is given."
+                    elif nickname in users:
+                        reason = "User nickname %s is ambiguous." % nickname
+                    else:
+                        reason = "Not find user %s." % nickname
+                    parsed.result.reject(line, reason)
+                    continue
+                root = union(parents, [(user.id, row[key]) for key in accounts])
+                owners[user.id] = user
+                routed.append((root, index, line, row))
+            # rows are kept by the shards from now on
+            parsed.rows = []
+        shards = {}
+        for root, index, line, row in routed:
+            key = find(parents, root)
+            if key not in shards:
+                shards[key] = Shard(owners[key[0]])
+            shards[key].add(index, line, row)
+        # biggest first, so that a big shard does not start last
+        return sorted(shards.values(), key=lambda shard: shard.rows, reverse=True)
+
+    def writer_count(self):
+        """
+        Writer threads to start. The MySQL pool refuses more connections
+        than its max_connections, connections held by the calling thread or
+        others are not free.
+        """
+        database = db.get_database()
+        pool_size = getattr(database, '_max_connections', None)
+        if not pool_size:
+            return self.connections or 1
+        free = pool_size - len(database._in_use)
+        return min(self.connections or free, free)
+
+    def writer_failed(self, err):
+        error("Ingest writer failed: %s" % err)
+        with self.lock:
+            self.errors.append(err)
+
+    def write_shard(self, importers, files, shard, progress):
+        importer = importers.get(shard.user.id)
+        if importer is None:
+            importer = Importer(DatabaseDriver(user=shard.user), batch_size=self.batch_size)
+            importers[shard.user.id] = importer
+        for index in sorted(shard.parts):
+            parsed = files[index]
+            result = ImportResult(parsed.result.kind, parsed.filename)
+            # identical rows are always in one shard, they share accounts
+            occurrences = {}
+            write = importer.writer(parsed.kind)
+            rows = shard.parts[index]
+            for start in range(0, len(rows), self.batch_size):
+                batch = []
+                for line, row in rows[start:start + self.batch_size]:
+                    try:
+                        batch.append((line, importer.resolve(parsed.kind, row)))
+                    except RejectRow as err:
+                        result.reject(line, err.message)
+                if batch:
+                    importer.write_batch(lambda items: write(items, occurrences), batch, result)
+                progress.add(len(rows[start:start + self.batch_size]))
+            result.elapsed = timer.perf_counter() - progress.start
+            with self.lock:
+                self.results.append((index, result))
+
+    def write_shards(self, files, shards, progress):
+        """Writer loop, takes shards until none is left."""
+        importers = {}
+        try:
+            while True:
+                try:
+                    shard = shards.get_nowait()
+                except queue.Empty:
+                    return
+                self.write_shard(importers, files, shard, progress)
+        except Exception as err:
+            self.writer_failed(err)
+
+    def connection_writer(self, files, shards, progress):
+        """Writer thread with its own connection, given back to the pool at the end."""
+        try:
+            with db.connection_context():
+                self.write_shards(files, shards, progress)
+        except Exception as err:
+            self.writer_failed(err)
+
+    def merge_results(self, files):
+        """One result per file, parse and write results combined."""
+        results = [parsed.result for parsed in files]
+        for index, result in self.results:
+            merged = results[index]
+            merged.inserted += result.inserted
+            merged.updated += result.updated
+            merged.skipped += result.skipped
+            merged.rejects.extend(result.rejects)
+            merged.elapsed = max(merged.elapsed, result.elapsed)
+        for result in results:
+            result.rejects.sort()
+        return results
+
+    def run(self, paths):
+        """
+        Ingest CSV files and directories of them, report every file and the
+        total throughput. Return the results of the files, in order.
+        """
+        start = timer.perf_counter()
+        filenames = collect_files(paths)
+        files = self.parse_files(filenames)
+        for parsed in files:
+            if parsed.error:
+                error("%s: %s" % (parsed.filename, parsed.error))
+                self.errors.append(parsed.error)
+        files = [parsed for parsed in files if not parsed.error]
+        parsed_at = timer.perf_counter()
+        info("Read %d files in %.3fs with %d processes." %
+                (len(files), parsed_at - start, min(self.processes, len(filenames) or 1)))
+
+        shards = self.make_shards(files)
+        progress = Progress(sum(shard.rows for shard in shards), self.progress_interval)
+        pending = queue.Queue()
+        for shard in shards:
+            pending.put(shard)
+        if is_sqlite():
+            connections = 1
+            self.write_shards(files, pending, progress)
+        else:
+            connections = max(1, min(self.writer_count(), len(shards)))
+            threads = [threading.Thread(target=self.connection_writer,
+                                        args=(files, pending, progress))
+                       for number in range(connections)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        results = self.merge_results(files)
+        for result in results:
+            result.report()
+        elapsed = timer.perf_counter() - start
+        rows = sum(result.inserted + result.updated + result.skipped + len(result.rejects)
+                   for result in results)
+        info("Ingested %d files: %d inserted, %d updated, %d skipped, %d rejected in %.3fs "
+             "(%.1f rows/s, %d shards, %d connections)" %
+                (len(results), sum(result.inserted for result in results),
+                 sum(result.updated for result in results),
+                 sum(result.skipped for result in results),
+                 sum(len(result.rejects) for result in results),
+                 elapsed, rows / elapsed if elapsed else 0.0, len(shards), connections))
+        if self.errors:
+            warning("%d files or writers failed, see the errors above." % len(self.errors))
+        return results
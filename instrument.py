@@ -0,0 +1,209 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for instrument DatabaseDriver: per method call counts,
+query counts and latencies, a slow query log with SQL and parameters, and
+an N+1 detector which flags the same query shape repeated inside one driver
+call.
+
+Nothing is wrapped until enable() is called, and disable() puts the
+original methods back, so instrumentation costs nothing when it is off.
+"""
+import json
+import re
+import threading
+import time as timer
+from collections import Counter, deque
+from utils import warning
+
+from app import db
+from dbdriver import DatabaseDriver
+
+# latencies kept per method for percentiles
+LATENCY_SAMPLES = 10000
+SLOW_QUERY_LOG_SIZE = 200
+
+# "?, ?, ?" and "%s, %s" lists of IN (...) and bulk inserts are one shape
+PLACEHOLDERS = re.compile(r'(\?|%s)(\s*,\s*(\?|%s))+')
+VALUE_ROWS = re.compile(r'(\([^()]*\))(\s*,\s*\([^()]*\))+')
+
+def query_shape(sql):
+    return VALUE_ROWS.sub(r'\1, ...', PLACEHOLDERS.sub('?, ...', sql))
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+class MethodStats():
+    def __init__(self):
+        self.calls = 0
+        self.queries = 0
+        self.total = 0.0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def snapshot(self):
+        return {'calls': self.calls, 'queries': self.queries, 'total': self.total,
+                'p95': percentile(self.latencies, 0.95)}
+
+class Frame():
+    def __init__(self, method):
+        self.method = method
+        self.shapes = Counter()
+
+class Instrumentation():
+    def __init__(self):
+        self.enabled = False
+        self.slow_threshold = 0.1
+        self.repeat_threshold = 10
+        self.log_file = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.originals = {}
+        self.database = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.query_count = 0
+            self.query_time = 0.0
+            self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+            self.repeated_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+    def enable(self, slow_threshold=0.1, repeat_threshold=10, log_file=None):
+        """
+        Start collecting. Queries slower than slow_threshold seconds are
+        logged, a query shape run repeat_threshold times or more inside one
+        driver call is reported as N+1. Findings are also written as JSON
+        lines to log_file (a path) if given.
+        """
+        self.slow_threshold = slow_threshold
+        self.repeat_threshold = repeat_threshold
+        if log_file:
+            self.log_file = open(log_file, 'a', encoding='utf-8')
+        if self.enabled:
+            return
+        for name, method in list(vars(DatabaseDriver).items()):
+            if name.startswith('_') or not callable(method):
+                continue
+            self.originals[name] = method
+            setattr(DatabaseDriver, name, self.wrap_method(name, method))
+        self.database = db.get_database()
+        self.database.execute_sql = self.wrap_execute(self.database.execute_sql)
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        for name, method in self.originals.items():
+            setattr(DatabaseDriver, name, method)
+        self.originals = {}
+        del self.database.execute_sql
+        self.database = None
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+        self.enabled = False
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def wrap_method(self, name, method):
+        instrumentation = self
+        def wrapper(*args, **kwargs):
+            stack = instrumentation.stack()
+            frame = Frame(name)
+            stack.append(frame)
+            start = timer.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = timer.perf_counter() - start
+                stack.pop()
+                instrumentation.finish_call(frame, elapsed, outermost=not stack)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        wrapper.__wrapped__ = method
+        return wrapper
+
+    def wrap_execute(self, execute_sql):
+        instrumentation = self
+        def wrapper(sql, params=None, *args, **kwargs):
+            start = timer.perf_counter()
+            try:
+                return execute_sql(sql, params, *args, **kwargs)
+            finally:
+                instrumentation.record_query(sql, params, timer.perf_counter() - start)
+        return wrapper
+
+    def method_stats(self, name):
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods[name] = MethodStats()
+        return stats
+
+    def finish_call(self, frame, elapsed, outermost):
+        with self.lock:
+            stats = self.method_stats(frame.method)
+            stats.calls += 1
+            stats.total += elapsed
+            stats.latencies.append(elapsed)
+        if not outermost:
+            # nested call, its queries belong to the caller too
+            parent = self.stack()[-1]
+            parent.shapes.update(frame.shapes)
+            return
+        for shape, count in frame.shapes.items():
+            if count >= self.repeat_threshold:
+                self.report('repeated_query', {'method': frame.method,
+                                               'sql': shape, 'count': count},
+                            self.repeated_queries)
+
+    def record_query(self, sql, params, elapsed):
+        stack = self.stack()
+        with self.lock:
+            self.query_count += 1
+            self.query_time += elapsed
+            for frame in stack:
+                self.method_stats(frame.method).queries += 1
+        if stack:
+            stack[-1].shapes[query_shape(sql)] += 1
+        if elapsed >= self.slow_threshold:
+            self.report('slow_query', {'method': stack[0].method if stack else None,
+                                       'sql': sql, 'params': list(params or ()),
+                                       'seconds': elapsed},
+                        self.slow_queries)
+
+    def report(self, kind, item, log):
+        log.append(item)
+        if kind == 'repeated_query':
+            warning("Possible N+1 in %(method)s: %(count)d x %(sql)s" % item)
+        if self.log_file:
+            self.log_file.write(json.dumps(dict(item, event=kind, time=timer.time()),
+                                           ensure_ascii=False, default=str) + "\n")
+            self.log_file.flush()
+
+    def snapshot(self):
+        """Statistics collected so far, as plain dicts."""
+        with self.lock:
+            return {'queries': self.query_count, 'query_time': self.query_time,
+                    'methods': {name: stats.snapshot()
+                                for name, stats in sorted(self.methods.items())},
+                    'slow_queries': list(self.slow_queries),
+                    'repeated_queries': list(self.repeated_queries)}
+
+instrumentation = Instrumentation()
+
+def enable(**options):
+    instrumentation.enable(**options)
+    return instrumentation
+
+def disable():
+    instrumentation.disable()
+
+def snapshot():
+    return instrumentation.snapshot()
@@ -0,0 +1,279 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for maintain database from command line without any
+interactive prompt, so that it can run from cron.
+
+Credentials come from --email/--password or FINANSE_EMAIL/FINANSE_PASSWORD.
+The batch command reads one command per line from a file (or '-' for
+stdin) and runs all of them over the same driver and connection:
+
+    import bills 2020-10.csv
+    ingest --user me@example.com statements/
+    report stats 2020-01 2020-12 --by group --output stats.csv
+    export --format npy ledger
+"""
+import time as timer
+# taken before the other imports, --timing reports from here
+STARTED = timer.perf_counter()
+
+import argparse
+import csv
+import os
+import shlex
+import sys
+from utils import info, error
+
+from app import db
+from dbdriver import DatabaseDriver, STAT_FIELDS
+from dbmodel import User
+from importer import Importer
+from ingest import Ingestor
+from schema import check_indexes, check_upgrade, get_schema_version
+
+EMAIL_ENV = 'FINANSE_EMAIL'
+PASSWORD_ENV = 'FINANSE_PASSWORD'
+REPORT_CACHE_ENV = 'FINANSE_REPORT_CACHE'
+
+class CommandError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+    pass
+
+def rebuild_stats(driver, args):
+    driver.rebuild_stat_months(args.start_month, args.end_month)
+    return 0
+
+def reconcile(driver, args):
+    drifts = driver.reconcile_balances(fix=args.fix)
+    if not drifts:
+        info("All balances are consistent.")
+        return 0
+    return 0 if args.fix else 1
+
+def explain_indexes(driver, args):
+    results = check_indexes()
+    return 0 if all(used for used, plan in results.values()) else 1
+
+def upgrade_baseline(driver, args):
+    return 1 if check_upgrade() else 0
+
+def show_schema(driver, args):
+    info("Database schema version is %d." % get_schema_version())
+    return 0
+
+def import_csv(driver, args):
+    importer = Importer(driver, batch_size=args.batch_size)
+    return 0 if importer.import_files(args.kind, args.files) else 1
+
+def ingest_files(driver, args):
+    owner = None
+    if args.user:
+        try:
+            owner = User.get(email=args.user)
+        except User.DoesNotExist:
+            raise CommandError("Not find user %s." % args.user)
+    ingestor = Ingestor(owner, processes=args.processes, connections=args.connections,
+                        batch_size=args.batch_size)
+    results = ingestor.run(args.paths)
+    return 0 if not ingestor.errors and all(not result.rejects for result in results) else 1
+
+def write_rows(output, header, rows):
+    if output == '-':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(header)
+        writer.writerows(rows)
+        return
+    with open(output, 'w', encoding='utf-8', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+    info("Report written to %s." % output)
+
+def report(driver, args):
+    if args.what == 'stats':
+        by = None if args.by == 'month' else args.by
+        items = driver.stat_report(args.start_month, args.end_month, by=by)
+        header = ('month', 'name') + STAT_FIELDS
+        rows = ((item['month'], item['name'] or '') +
+                tuple(item[field] for field in STAT_FIELDS) for item in items)
+    else:
+        items = driver.net_worth_series(args.start_month, args.end_month)
+        header = ('month', 'assets', 'debts', 'net_worth')
+        rows = (tuple(item[field] for field in header) for item in items)
+    write_rows(args.output, header, rows)
+    return 0
+
+def export_ledger(driver, args):
+    # numpy is imported by export only, commands without it start faster
+    from export import Exporter, KINDS
+    for kind in args.kinds:
+        if kind not in KINDS:
+            raise CommandError("Unknown kind %s to export." % kind)
+    Exporter(driver, args.start, args.end).export(args.output, args.format, args.kinds)
+    return 0
+
+def rollback_open_transaction():
+    """Roll back a transaction left open by a failed command."""
+    if db.is_closed() or not db.in_transaction():
+        return
+    db.rollback()
+    while db.in_transaction():
+        db.pop_transaction()
+
+def batch(driver, args):
+    """Run every command of a file in order, stop at the first failure unless --keep-going."""
+    parser = make_parser(commands_only=True)
+    jobs = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')
+    failed = 0
+    with jobs:
+        for line_number, line in enumerate(jobs, start=1):
+            command = shlex.split(line, comments=True)
+            if not command:
+                continue
+            start = timer.perf_counter()
+            try:
+                job = parser.parse_args(command)
+                if job.func is batch:
+                    raise CommandError("Nested batch is not supported.")
+                code = job.func(driver, job)
+            except CommandError as err:
+                error("Line %d: %s" % (line_number, err.message))
+                code = 1
+            except Exception as err:
+                # any failure is one failed line, the next lines run on a clean connection
+                error("Line %d: %s: %s" % (line_number, type(err).__name__, err))
+                rollback_open_transaction()
+                code = 1
+            info("Line %d (%s) finished with %d in %.3fs." %
+                    (line_number, command[0], code, timer.perf_counter() - start))
+            if code:
+                failed += 1
+                if not args.keep_going:
+                    break
+    return 1 if failed else 0
+
+class CommandParser(argparse.ArgumentParser):
+    """Parser of batch lines, which reports bad lines instead of exiting."""
+    def error(self, message):
+        raise CommandError(message)
+
+def add_commands(parser):
+    commands = parser.add_subparsers(dest='command', required=True,
+                                     parser_class=type(parser))
+
+    rebuild = commands.add_parser('rebuild-stats',
+                                  help="recompute month statistics from bills and transfers")
+    rebuild.add_argument('start_month', help="first month, YYYY-MM")
+    rebuild.add_argument('end_month', nargs='?', help="last month, YYYY-MM")
+    rebuild.set_defaults(func=rebuild_stats)
+
+    check = commands.add_parser('reconcile',
+                                help="check stored balances against bills and transfers")
+    check.add_argument('--fix', action='store_true',
+                       help="overwrite drifted balances with the recomputed ones")
+    check.set_defaults(func=reconcile)
+
+    explain = commands.add_parser('check-indexes',
+                                  help="EXPLAIN the driver queries and check their indexes")
+    explain.set_defaults(func=explain_indexes, anonymous=True)
+
+    upgrade = commands.add_parser('check-upgrade',
+                                  help="upgrade a database of the first release in a "
+                                       "temporary file and check it")
+    upgrade.set_defaults(func=upgrade_baseline, anonymous=True)
+
+    schema = commands.add_parser('schema',
+                                 help="create or migrate the schema and show its version")
+    schema.set_defaults(func=show_schema, anonymous=True)
+
+    load = commands.add_parser('import', help="import CSV files")
+    load.add_argument('--batch-size', type=int, default=500,
+                      help="rows written in one transaction")
+    load.add_argument('kind', choices=('bills', 'transfers', 'stats'))
+    load.add_argument('files', nargs='+', help="CSV files to import")
+    load.set_defaults(func=import_csv)
+
+    ingest = commands.add_parser('ingest',
+                                 help="import CSV files of any users in parallel")
+    ingest.add_argument('--user', metavar='EMAIL',
+                        help="owner of rows without a user column")
+    ingest.add_argument('--processes', type=int,
+                        help="processes reading files, the number of CPUs by default")
+    ingest.add_argument('--connections', type=int,
+                        help="database connections writing, "
+                             "the free connections of the pool by default")
+    ingest.add_argument('--batch-size', type=int, default=500,
+                        help="rows written in one transaction")
+    ingest.add_argument('paths', nargs='+', help="CSV files or directories of them")
+    ingest.set_defaults(func=ingest_files, anonymous=True)
+
+    summary = commands.add_parser('report', help="write a report as CSV")
+    summary.add_argument('what', choices=('stats', 'net-worth'),
+                         help="month statistics or month end net worth")
+    summary.add_argument('start_month', help="first month, YYYY-MM")
+    summary.add_argument('end_month', nargs='?', help="last month, YYYY-MM")
+    summary.add_argument('--by', choices=('account', 'group', 'user', 'month'),
+                         default='account', help="grouping of month statistics")
+    summary.add_argument('--output', default='-', help="CSV file, '-' for stdout")
+    summary.set_defaults(func=report)
+
+    dump = commands.add_parser('export', help="export the ledger")
+    dump.add_argument('--start', help="first date, YYYY-MM-DD")
+    dump.add_argument('--end', help="last date, YYYY-MM-DD")
+    dump.add_argument('--format', choices=('csv', 'npy'), default='csv')
+    dump.add_argument('output', help="output directory")
+    dump.add_argument('kinds', nargs='*',
+                      help="accounts, bills, transfers or stats, all by default")
+    dump.set_defaults(func=export_ledger)
+
+    jobs = commands.add_parser('batch', help="run commands of a file over one connection")
+    jobs.add_argument('--keep-going', action='store_true',
+                      help="run the remaining commands after a failed one")
+    jobs.add_argument('file', help="one command per line, '-' for stdin")
+    jobs.set_defaults(func=batch)
+
+def make_parser(commands_only=False):
+    if commands_only:
+        parser = CommandParser(prog='batch', add_help=False)
+        add_commands(parser)
+        return parser
+    parser = argparse.ArgumentParser(description="Maintain Finanse database.")
+    parser.add_argument('--email', default=os.environ.get(EMAIL_ENV),
+                        help="login email of the owner, or %s" % EMAIL_ENV)
+    parser.add_argument('--password', default=os.environ.get(PASSWORD_ENV),
+                        help="login password of the owner, or %s" % PASSWORD_ENV)
+    parser.add_argument('--report-cache', metavar='DIR', default=os.environ.get(REPORT_CACHE_ENV),
+                        help="keep computed reports in DIR across runs, or %s" % REPORT_CACHE_ENV)
+    parser.add_argument('--timing', action='store_true',
+                        help="report start up and run time")
+    add_commands(parser)
+    return parser
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+
+    imported = timer.perf_counter()
+    driver = DatabaseDriver(report_cache_dir=args.report_cache)
+    # DatabaseDriver checks the schema, that is the first query
+    connected = timer.perf_counter()
+    if not getattr(args, 'anonymous', False) and \
+            not driver.authenticate(args.email, args.password):
+        error("Login failed for %s." % args.email)
+        db.close()
+        return 1
+
+    try:
+        code = args.func(driver, args)
+    except CommandError as err:
+        error(err.message)
+        code = 1
+    finally:
+        db.close()
+    if args.timing:
+        info("Imports %.3fs, first query %.3fs, command %.3fs." %
+                (imported - STARTED, connected - imported, timer.perf_counter() - connected))
+    return code
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,38 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for keep money exact. Amounts are stored and summed as
+integer cents (分); they are converted from and to Decimal yuan only at the
+edges: parsing input and reporting results.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from peewee import BigIntegerField
+
+CENTS_PER_UNIT = 100
+CENT = Decimal('0.01')
+
+def to_cents(value):
+    """Convert an amount in yuan (str, int, float or Decimal) to integer cents."""
+    if isinstance(value, float):
+        # repr gives the shortest text which reads back as the same float
+        value = repr(value)
+    cents = Decimal(value) * CENTS_PER_UNIT
+    return int(cents.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_cents(cents):
+    """Convert integer cents (or a database SUM of them) to Decimal yuan."""
+    if cents is None:
+        return None
+    return (Decimal(int(cents)) / CENTS_PER_UNIT).quantize(CENT)
+
+class MoneyField(BigIntegerField):
+    """Integer cents. Only ints are accepted, convert input with to_cents()."""
+    def db_value(self, value):
+        if value is None or isinstance(value, int):
+            return value
+        raise TypeError("Money of %s must be integer cents, got %r." % (self.name, value))
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        # rows migrated from float columns may still come back as REAL
+        return int(round(value))
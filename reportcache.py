@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for cache computed reports. Every entry keeps the
+fingerprint of the write versions it was computed from (see
+DatabaseDriver.write_fingerprint()); an entry whose fingerprint differs from
+the current one is stale and computed again.
+
+Entries live in a bounded LRU dict, and optionally in a directory as pickle
+files too, so that they survive restarts of short lived processes.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+from utils import warning
+
+REPORT_CACHE_SIZE = 128
+# entries kept in the directory, the oldest written ones are removed first
+DISK_CACHE_SIZE = 1024
+
+# returned by get() when there is no fresh entry, a report may be None
+MISSING = object()
+
+class ReportCache():
+    def __init__(self, size=REPORT_CACHE_SIZE, directory=None, disk_size=DISK_CACHE_SIZE,
+                 enabled=True):
+        self.size = size
+        self.directory = directory
+        self.disk_size = disk_size
+        self.enabled = enabled
+        self.items = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.stale = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        name = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.pickle')
+
+    def load(self, key):
+        try:
+            with open(self.path(key), 'rb') as cache_file:
+                stored_key, fingerprint, value = pickle.load(cache_file)
+        except (OSError, pickle.PickleError, EOFError, AttributeError, ValueError):
+            return None
+        if stored_key != key:
+            return None
+        return fingerprint, value
+
+    def dump(self, key, fingerprint, value):
+        try:
+            data = pickle.dumps((key, fingerprint, value))
+        except (pickle.PickleError, TypeError, AttributeError) as err:
+            warning("Report %r is not cached on disk: %s" % (key, err))
+            return
+        # written aside and renamed, readers never see half a file
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, self.path(key))
+        self.trim_disk()
+
+    def trim_disk(self):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith('.pickle')]
+        if len(paths) <= self.disk_size:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.disk_size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key, fingerprint):
+        """The cached report of key computed at fingerprint, or MISSING."""
+        if not self.enabled:
+            return MISSING
+        item = self.items.get(key)
+        if item is None and self.directory:
+            item = self.load(key)
+            if item is not None and item[0] == fingerprint:
+                self.disk_hits += 1
+                self.remember(key, item)
+                return item[1]
+        if item is None:
+            self.misses += 1
+            return MISSING
+        if item[0] != fingerprint:
+            self.stale += 1
+            return MISSING
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def remember(self, key, item):
+        self.items[key] = item
+        self.items.move_to_end(key)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def put(self, key, fingerprint, value):
+        if not self.enabled:
+            return
+        self.remember(key, (fingerprint, value))
+        if self.directory:
+            self.dump(key, fingerprint, value)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.stale + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'stale': self.stale,
+                'misses': self.misses, 'size': len(self.items),
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'enabled': self.enabled}
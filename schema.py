@@ -0,0 +1,545 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for create and migrate database schema. Every change of
+the models after the first release is a numbered migration, so existing
+deployments are upgraded in place instead of rebuilt.
+"""
+import os
+import re
+import tempfile
+import weakref
+from peewee import fn, DatabaseError, MySQLDatabase, SqliteDatabase
+from playhouse.migrate import SchemaMigrator, Operation, migrate
+from utils import info, warning
+
+from dbmodel import User, Bill, Transfer, \
+                          Account, AccountGroup, AccountStatMonth, WriteVersion, SchemaVersion
+from app import db, is_sqlite
+from money import MoneyField
+from search import create_search_indexes, match
+from fingerprint import assign_hashes, merge_occurrences, bill_values, transfer_values
+
+MODELS = (User, AccountGroup, Account, Bill, Transfer, AccountStatMonth, WriteVersion)
+
+class MigrationError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+    pass
+
+def add_missing_indexes(model, indexes):
+    """
+    Create indexes of model ((field names, unique) like Meta.indexes) which
+    are not in database yet. Every migration gives its own list, Meta may
+    declare indexes on columns added by later migrations.
+    """
+    table = model._meta.table_name
+    existed = set(tuple(index.columns) for index in db.get_indexes(table))
+    operations = []
+    migrator = SchemaMigrator.from_database(db.get_database())
+    for fields, unique in indexes:
+        columns = tuple(model._meta.fields[name].column_name for name in fields)
+        if columns in existed:
+            continue
+        operations.append(migrator.add_index(table, columns, unique))
+    migrate(*operations)
+    return len(operations)
+
+def migrate_1():
+    """Composite indexes on the hot query columns."""
+    duplicates = (AccountStatMonth
+                  .select(AccountStatMonth.account_id, AccountStatMonth.date)
+                  .group_by(AccountStatMonth.account_id, AccountStatMonth.date)
+                  .having(fn.COUNT(AccountStatMonth.id) > 1)
+                  .tuples())
+    duplicates = list(duplicates)
+    if duplicates:
+        raise MigrationError("Month statistics %s are duplicated, merge them before "
+                             "upgrading." % ", ".join("%s@%s" % item for item in duplicates))
+    add_missing_indexes(Account, [(('account_name', 'user_id'), False)])
+    add_missing_indexes(Bill, [(('user_id', 'account_id', 'billing_date'), False)])
+    add_missing_indexes(Transfer, [(('from_account_id', 'transfer_date'), False),
+                                   (('to_account_id', 'transfer_date'), False)])
+    add_missing_indexes(AccountStatMonth, [(('account_id', 'date'), True)])
+
+def migrate_2():
+    """Indexes for date ordered paging of bills and transfers of a user."""
+    add_missing_indexes(Bill, [(('user_id', 'billing_date'), False)])
+    add_missing_indexes(Transfer, [(('user_id', 'transfer_date'), False)])
+
+MONEY_COLUMNS = (
+    (Account, ('init_balance', 'remain_balance')),
+    (Bill, ('amount',)),
+    (Transfer, ('amount',)),
+    (AccountStatMonth, ('amount', 'adjust', 'interest_income', 'invest_income',
+                        'normal_income', 'normal_outcome', 'transfer')),
+)
+
+# cents are computed into this copy of a MySQL money column first
+CENTS_SUFFIX = '_cents'
+
+def render(operation):
+    """[(sql, params)] of a playhouse.migrate operation, without running it."""
+    result = operation.fn(operation.migrator, *operation.args, **operation.kwargs)
+    statements = []
+    for item in result if isinstance(result, (list, tuple)) else [result]:
+        if isinstance(item, Operation):
+            statements.extend(render(item))
+        else:
+            statements.append(operation.migrator.database.get_sql_context().sql(item).query())
+    return statements
+
+def money_column_steps(migrator, table, field, data_type, copied):
+    """
+    Statements [(sql, params)] moving a MySQL money column from FLOAT yuan
+    to BIGINT cents, from its current DATA_TYPE and whether its cents copy
+    exists. Cents are computed into the copy, then the column type is
+    changed and the cents are copied back; MySQL commits every DDL, so
+    each state an interrupted upgrade leaves is resumed without scaling
+    twice.
+    """
+    column = field.column_name
+    copy = column + CENTS_SUFFIX
+    # unbound, the DDL of a bound field repeats the column name
+    money = MoneyField(null=field.null, constraints=field.constraints)
+    steps = []
+    if data_type == 'double':
+        # left by an earlier version of this migration, already in cents
+        return render(migrator.alter_column_type(table, column, money))
+    if data_type != 'bigint':
+        if not copied:
+            steps.append(('ALTER TABLE `%s` ADD COLUMN `%s` BIGINT NULL' % (table, copy), []))
+        # FLOAT values are computed in double precision, stored as BIGINT
+        steps.append(('UPDATE `%s` SET `%s` = ROUND(`%s` * 100)' % (table, copy, column), []))
+        steps.extend(render(migrator.alter_column_type(table, column, money)))
+        copied = True
+    if copied:
+        steps.append(('UPDATE `%s` SET `%s` = `%s`' % (table, column, copy), []))
+        steps.append(('ALTER TABLE `%s` DROP COLUMN `%s`' % (table, copy), []))
+    return steps
+
+def column_types(table):
+    """{column: DATA_TYPE} of a MySQL table."""
+    cursor = db.execute_sql("SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+                            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,))
+    return dict((name, data_type.lower()) for name, data_type in cursor.fetchall())
+
+def migrate_3():
+    """Money columns from float yuan to integer cents."""
+    if is_sqlite():
+        # sqlite keeps the REAL columns, they hold whole cents exactly and
+        # MoneyField reads them back as int
+        for model, names in MONEY_COLUMNS:
+            fields = [model._meta.fields[name] for name in names]
+            model.update({field: fn.ROUND(field * 100) for field in fields}).execute()
+        return
+    migrator = SchemaMigrator.from_database(db.get_database())
+    for model, names in MONEY_COLUMNS:
+        table = model._meta.table_name
+        types = column_types(table)
+        for name in names:
+            field = model._meta.fields[name]
+            for sql, params in money_column_steps(migrator, table, field,
+                                                  types[field.column_name],
+                                                  field.column_name + CENTS_SUFFIX in types):
+                db.execute_sql(sql, params)
+
+# rows hashed at a time by migrate_4
+BACKFILL_BATCH_SIZE = 1000
+
+def backfill_hashes(model, columns, values):
+    """
+    Hash existing rows in id order. Identical rows of a user are counted as
+    occurrences of one statement, like a reload of all of them would be.
+    """
+    occurrences = {}
+    last_id = 0
+    while True:
+        rows = list(model
+                    .select(model.id, *[model._meta.fields[name] for name in columns])
+                    .where(model.id > last_id)
+                    .order_by(model.id)
+                    .limit(BACKFILL_BATCH_SIZE)
+                    .dicts())
+        if not rows:
+            break
+        # ids of foreign keys come back under the field names
+        merge_occurrences(occurrences, assign_hashes(rows, values, occurrences))
+        for row in rows:
+            model.update(content_hash=row['content_hash']).where(model.id==row['id']).execute()
+        last_id = rows[-1]['id']
+
+def migrate_4():
+    """Content hashes of bills and transfers for idempotent imports."""
+    migrator = SchemaMigrator.from_database(db.get_database())
+    for model in (Bill, Transfer):
+        table = model._meta.table_name
+        field = model._meta.fields['content_hash']
+        if field.column_name not in [column.name for column in db.get_columns(table)]:
+            migrate(migrator.add_column(table, field.column_name, field))
+    backfill_hashes(Bill, ('user_id', 'account_id', 'inout_type', 'amount',
+                           'billing_date', 'billing_time', 'comments'), bill_values)
+    backfill_hashes(Transfer, ('user_id', 'from_account_id', 'to_account_id', 'amount',
+                               'transfer_date', 'transfer_time', 'comments'), transfer_values)
+    for model in (Bill, Transfer):
+        add_missing_indexes(model, [(('content_hash',), True)])
+
+def migrate_5():
+    """Opening balance checkpoints of month statistics."""
+    migrator = SchemaMigrator.from_database(db.get_database())
+    table = AccountStatMonth._meta.table_name
+    field = AccountStatMonth._meta.fields['opening_balance']
+    # left null, DatabaseDriver computes checkpoints when they are asked for
+    migrate(migrator.add_column(table, field.column_name, field))
+
+def migrate_6():
+    """Search indexes of bill and transfer comments."""
+    create_search_indexes()
+
+def migrate_7():
+    """Write versions of the report cache."""
+    # the table is created with the other missing tables before migrating
+    WriteVersion.create_table()
+
+def check_constraints(table, column):
+    """
+    Names of the MySQL CHECK constraints of table on column. Servers before
+    MySQL 8.0.16 parse CHECK and ignore it, they have none.
+    """
+    try:
+        cursor = db.execute_sql(
+            "SELECT tc.CONSTRAINT_NAME, cc.CHECK_CLAUSE "
+            "FROM information_schema.TABLE_CONSTRAINTS tc "
+            "JOIN information_schema.CHECK_CONSTRAINTS cc "
+            "ON cc.CONSTRAINT_SCHEMA = tc.CONSTRAINT_SCHEMA "
+            "AND cc.CONSTRAINT_NAME = tc.CONSTRAINT_NAME "
+            "WHERE tc.TABLE_SCHEMA = DATABASE() AND tc.TABLE_NAME = %s "
+            "AND tc.CONSTRAINT_TYPE = 'CHECK'", (table,))
+    except DatabaseError:
+        return []
+    return [name for name, clause in cursor.fetchall() if column in clause]
+
+def rebuild_table(model):
+    """
+    Rebuild a SQLite table from its model, the way SQLite changes column
+    constraints. Foreign keys must be off, see upgrade_schema().
+    """
+    table = model._meta.table_name
+    temp = table + '__new'
+    sql, params = model._schema._create_table(safe=False).query()
+    db.execute_sql(sql.replace('"%s"' % table, '"%s"' % temp, 1), params)
+    existed = set(column.name for column in db.get_columns(table))
+    columns = ', '.join('"%s"' % field.column_name for field in model._meta.sorted_fields
+                        if field.column_name in existed)
+    db.execute_sql('INSERT INTO "%s" (%s) SELECT %s FROM "%s"' % (temp, columns, columns, table))
+    db.execute_sql('DROP TABLE "%s"' % table)
+    db.execute_sql('ALTER TABLE "%s" RENAME TO "%s"' % (temp, table))
+    model._schema.create_indexes()
+    broken = db.execute_sql('PRAGMA foreign_key_check').fetchall()
+    if broken:
+        raise MigrationError("Foreign keys are broken after rebuilding %s: %s" % (table, broken))
+
+def migrate_8():
+    """Running balances may go below zero, drop the remain_balance CHECK."""
+    table = Account._meta.table_name
+    column = Account.remain_balance.column_name
+    if not is_sqlite():
+        for name in check_constraints(table, column):
+            db.execute_sql('ALTER TABLE `%s` DROP CHECK `%s`' % (table, name))
+        return
+    sql = db.execute_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                         (table,)).fetchone()[0]
+    if 'CHECK (%s' % column in sql:
+        rebuild_table(Account)
+
+# version: migration, applied in order
+MIGRATIONS = {
+    1: migrate_1,
+    2: migrate_2,
+    3: migrate_3,
+    4: migrate_4,
+    5: migrate_5,
+    6: migrate_6,
+    7: migrate_7,
+    8: migrate_8,
+}
+SCHEMA_VERSION = max(MIGRATIONS)
+
+def get_schema_version():
+    version = SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar()
+    return version or 0
+
+# databases already checked in this process, with their schema version
+CHECKED = weakref.WeakKeyDictionary()
+
+def ensure_schema():
+    """
+    Make sure the database is at the latest schema version. The usual case
+    costs one query (the version) per process and database; tables are
+    only introspected, created and migrated when the version is behind.
+    """
+    database = db.get_database()
+    if CHECKED.get(database) == SCHEMA_VERSION:
+        return SCHEMA_VERSION
+    try:
+        version = get_schema_version()
+    except DatabaseError:
+        # no version table yet
+        version = None
+    if version != SCHEMA_VERSION:
+        upgrade_schema(version)
+    CHECKED[database] = SCHEMA_VERSION
+    return SCHEMA_VERSION
+
+def upgrade_schema(version):
+    """
+    Create missing tables and apply pending migrations after version (None
+    when there is no version table). A brand new database is created at
+    the latest version directly.
+    """
+    # one introspection query for all tables
+    tables = set(db.get_tables())
+    if version is None:
+        fresh = not tables.intersection(model._meta.table_name for model in MODELS)
+        version = SCHEMA_VERSION if fresh else 0
+        with db.atomic():
+            SchemaVersion.create_table()
+            SchemaVersion.create(version=version)
+
+    for model in MODELS:
+        if model._meta.table_name not in tables:
+            model.create_table()
+    if Bill._meta.table_name not in tables:
+        # not declared in models, made by migration 6 on older databases
+        create_search_indexes()
+
+    if version == SCHEMA_VERSION:
+        return
+    # SQLite asks for foreign keys off while a table is rebuilt, it can
+    # not be switched inside a transaction
+    foreign_keys = is_sqlite() and db.pragma('foreign_keys')
+    if foreign_keys:
+        db.pragma('foreign_keys', 0)
+    try:
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            info("Migrate database schema to version %d: %s" %
+                    (target, MIGRATIONS[target].__doc__))
+            with db.atomic():
+                MIGRATIONS[target]()
+                SchemaVersion.update(version=target).execute()
+    finally:
+        if foreign_keys:
+            db.pragma('foreign_keys', foreign_keys)
+
+def explain(query):
+    """Return the plan of a query as a list of text rows."""
+    sql, params = query.sql()
+    if is_sqlite():
+        cursor = db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+    cursor = db.execute_sql('EXPLAIN ' + sql, params)
+    names = [column[0] for column in cursor.description]
+    return ["table=%s key=%s type=%s" % (item.get('table'), item.get('key'), item.get('type'))
+            for item in (dict(zip(names, row)) for row in cursor.fetchall())]
+
+def uses_index(plan):
+    for row in plan:
+        if ' INDEX ' in row or 'PRIMARY KEY' in row or 'VIRTUAL TABLE INDEX' in row:
+            continue
+        if row.startswith('SCAN ') or 'key=None' in row:
+            return False
+    return True
+
+def driver_queries(user_id=0, account_id=0):
+    """Representative queries issued by DatabaseDriver on the hot paths."""
+    return {
+        'account by name': Account.select().where(Account.account_name=='',
+                                                  Account.user_id==user_id),
+        'bills of account': Bill.select().where(Bill.user_id==user_id,
+                                                Bill.account_id==account_id,
+                                                Bill.billing_date >= '2000-01-01'),
+        'bills page of user': Bill.select().where(
+                Bill.user_id==user_id,
+                Bill.billing_date >= '2000-01-01').order_by(Bill.billing_date, Bill.id),
+        'bill by content hash': Bill.select(Bill.content_hash).where(
+                Bill.content_hash.in_(['0' * 64])),
+        'bills by comment': match(Bill.select().where(Bill.user_id==user_id), Bill, '买菜'),
+        'transfers out of account': Transfer.select().where(
+                Transfer.from_account_id==account_id,
+                Transfer.transfer_date >= '2000-01-01'),
+        'transfers into account': Transfer.select().where(
+                Transfer.to_account_id==account_id,
+                Transfer.transfer_date >= '2000-01-01'),
+        'month statistic of account': AccountStatMonth.select().where(
+                AccountStatMonth.account_id==account_id,
+                AccountStatMonth.date=='2000-01-01'),
+    }
+
+def check_indexes(queries=None):
+    """
+    EXPLAIN the driver queries and report whether each of them uses an
+    index. Return {name: (used, plan)}.
+    Note MySQL may still choose a full scan on tiny tables.
+    """
+    results = {}
+    for name, query in (queries or driver_queries()).items():
+        plan = explain(query)
+        used = uses_index(plan)
+        results[name] = (used, plan)
+        if used:
+            info("Query '%s' uses index: %s" % (name, "; ".join(plan)))
+        else:
+            warning("Query '%s' does not use index: %s" % (name, "; ".join(plan)))
+    return results
+
+# tables of the first release as created on SQLite, with a few rows, for
+# check_upgrade()
+BASELINE_SCHEMA = (
+    'CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY, "email" VARCHAR(30) NOT NULL, '
+    '"password" VARCHAR(64) NOT NULL, "nickname" VARCHAR(30) NOT NULL)',
+    'CREATE UNIQUE INDEX "user_email" ON "user" ("email")',
+    'CREATE TABLE "accountgroup" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"account_group_name" VARCHAR(30) NOT NULL, "comments" VARCHAR(50), '
+    '"user_id" INTEGER NOT NULL, FOREIGN KEY ("user_id") REFERENCES "user" ("id"))',
+    'CREATE INDEX "accountgroup_user_id" ON "accountgroup" ("user_id")',
+    'CREATE TABLE "account" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"account_name" VARCHAR(30) NOT NULL, "is_credit" INTEGER NOT NULL DEFAULT False, '
+    '"init_balance" REAL NOT NULL CHECK (init_balance >= 0.0) DEFAULT 0.0, '
+    '"remain_balance" REAL NOT NULL CHECK (remain_balance >= 0.0) DEFAULT 0.0, '
+    '"currency" VARCHAR(255) NOT NULL CHECK (currency=\'RMB\' OR currency=\'Dollar\') '
+    'DEFAULT \'RMB\', "user_id" INTEGER NOT NULL, "account_group_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("user_id") REFERENCES "user" ("id"), '
+    'FOREIGN KEY ("account_group_id") REFERENCES "accountgroup" ("id"))',
+    'CREATE INDEX "account_user_id" ON "account" ("user_id")',
+    'CREATE INDEX "account_account_group_id" ON "account" ("account_group_id")',
+    'CREATE TABLE "accountstatmonth" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"date" DATE NOT NULL, "account_id" INTEGER NOT NULL, '
+    '"amount" REAL NOT NULL DEFAULT 0.0, "adjust" REAL NOT NULL DEFAULT 0.0, '
+    '"interest_income" REAL NOT NULL DEFAULT 0.0, "invest_income" REAL NOT NULL DEFAULT 0.0, '
+    '"normal_income" REAL NOT NULL CHECK (normal_income >= 0.0) DEFAULT 0.0, '
+    '"normal_outcome" REAL NOT NULL CHECK (normal_outcome >= 0.0) DEFAULT 0.0, '
+    '"transfer" REAL NOT NULL DEFAULT 0.0, '
+    'FOREIGN KEY ("account_id") REFERENCES "account" ("id"))',
+    'CREATE INDEX "accountstatmonth_account_id" ON "accountstatmonth" ("account_id")',
+    'CREATE TABLE "bill" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"amount" REAL NOT NULL CHECK (amount >= 0.0) DEFAULT 0.0, '
+    '"inout_type" VARCHAR(10) NOT NULL CHECK (inout_type=\'支出\' OR inout_type=\'收入\') '
+    'DEFAULT \'支出\', "created_datetime" DATETIME DEFAULT CURRENT_TIMESTAMP, '
+    '"billing_date" DATE, "billing_time" TIME, "comments" VARCHAR(50), '
+    '"account_id" INTEGER NOT NULL, "user_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("account_id") REFERENCES "account" ("id"), '
+    'FOREIGN KEY ("user_id") REFERENCES "user" ("id"))',
+    'CREATE INDEX "bill_account_id" ON "bill" ("account_id")',
+    'CREATE INDEX "bill_user_id" ON "bill" ("user_id")',
+    'CREATE TABLE "transfer" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"amount" REAL NOT NULL CHECK (amount >= 0.0) DEFAULT 0.0, '
+    '"created_datetime" DATETIME DEFAULT CURRENT_TIMESTAMP, '
+    '"transfer_date" DATE, "transfer_time" TIME, "comments" VARCHAR(50), '
+    '"from_account_id" INTEGER NOT NULL, "to_account_id" INTEGER NOT NULL, '
+    '"user_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("from_account_id") REFERENCES "account" ("id"), '
+    'FOREIGN KEY ("to_account_id") REFERENCES "account" ("id"), '
+    'FOREIGN KEY ("user_id") REFERENCES "user" ("id"))',
+    'CREATE INDEX "transfer_from_account_id" ON "transfer" ("from_account_id")',
+    'CREATE INDEX "transfer_to_account_id" ON "transfer" ("to_account_id")',
+    'CREATE INDEX "transfer_user_id" ON "transfer" ("user_id")',
+    # two identical bills, the unique content hash index must keep both
+    'INSERT INTO "user" VALUES (1, \'check@finanse.test\', \'check\', \'check\')',
+    'INSERT INTO "accountgroup" VALUES (1, \'日常开支\', NULL, 1)',
+    'INSERT INTO "account" VALUES (1, \'储蓄卡\', 0, 100.5, 90.5, \'RMB\', 1, 1), '
+    '(2, \'信用卡\', 1, 0.0, 5.0, \'RMB\', 1, 1)',
+    'INSERT INTO "bill" ("amount", "inout_type", "billing_date", "comments", "account_id", '
+    '"user_id") VALUES (5.0, \'支出\', \'2020-01-02\', \'买菜\', 1, 1), '
+    '(5.0, \'支出\', \'2020-01-02\', \'买菜\', 1, 1)',
+    'INSERT INTO "transfer" ("amount", "transfer_date", "from_account_id", "to_account_id", '
+    '"user_id") VALUES (5.0, \'2020-01-03\', 1, 2, 1)',
+    'INSERT INTO "accountstatmonth" ("date", "account_id", "amount", "normal_outcome") '
+    'VALUES (\'2020-01-01\', 1, 90.5, 10.0)',
+)
+
+def upgrade_problems():
+    """Differences of the upgraded check_upgrade() database from the expected one."""
+    problems = []
+    version = get_schema_version()
+    if version != SCHEMA_VERSION:
+        problems.append("Schema version is %d, not %d." % (version, SCHEMA_VERSION))
+    for model in MODELS:
+        existed = set(tuple(index.columns) for index in db.get_indexes(model._meta.table_name))
+        for fields, unique in model._meta.indexes:
+            columns = tuple(model._meta.fields[name].column_name for name in fields)
+            if columns not in existed:
+                problems.append("Index %s(%s) is missing." %
+                                (model._meta.table_name, ", ".join(columns)))
+    for model in (Bill, Transfer):
+        if model.select().where(model.content_hash.is_null()).count():
+            problems.append("Rows of %s are not hashed." % model._meta.table_name)
+    if Bill.select().count() != 2:
+        problems.append("Identical bills are not kept.")
+    if Account.get_by_id(1).init_balance != 10050:
+        problems.append("Money is not converted to cents.")
+    try:
+        with db.atomic() as transaction:
+            Account.update(remain_balance=-100).where(Account.id==1).execute()
+            transaction.rollback()
+    except DatabaseError as err:
+        problems.append("Balance can not go below zero: %s" % err)
+    return problems
+
+# states of a MySQL money column met by migrate_3: (DATA_TYPE, cents copy exists)
+MONEY_COLUMN_STATES = (('float', False), ('float', True), ('bigint', True),
+                       ('double', False), ('bigint', False))
+
+def migration_sql_problems():
+    """
+    Render the MySQL statements of migrate_3 for every state of every money
+    column, no server is needed, and check them.
+    """
+    migrator = SchemaMigrator.from_database(MySQLDatabase('check'))
+    problems = []
+    for model, names in MONEY_COLUMNS:
+        table = model._meta.table_name
+        for name in names:
+            column = model._meta.fields[name].column_name
+            modify = re.compile(r'^ALTER TABLE `%s` MODIFY `%s`\s+BIGINT ' % (table, column))
+            for data_type, copied in MONEY_COLUMN_STATES:
+                steps = money_column_steps(migrator, table, model._meta.fields[name],
+                                           data_type, copied)
+                where = "%s.%s (%s%s)" % (table, column, data_type,
+                                          ", copied" if copied else "")
+                for sql, params in steps:
+                    if ' MODIFY ' in sql and not modify.match(sql):
+                        problems.append("Invalid MODIFY of %s: %s" % (where, sql))
+                if sum(1 for sql, params in steps if '* 100' in sql) > (data_type == 'float'):
+                    problems.append("Money of %s is scaled again." % where)
+                if data_type == 'bigint' and not copied and steps:
+                    problems.append("Migrated column %s is changed again." % where)
+    return problems
+
+def check_upgrade():
+    """
+    Upgrade a SQLite database of the first release (BASELINE_SCHEMA) to the
+    latest version in a temporary directory, and check the result and the
+    MySQL statements of the migrations. The configured database is not
+    touched. Return a list of problems.
+    """
+    previous = db.obj
+    with tempfile.TemporaryDirectory() as directory:
+        baseline = SqliteDatabase(os.path.join(directory, 'baseline.db'),
+                                  pragmas={'foreign_keys': 1})
+        for sql in BASELINE_SCHEMA:
+            baseline.execute_sql(sql)
+        db.initialize(baseline)
+        try:
+            ensure_schema()
+            problems = upgrade_problems()
+        except (DatabaseError, MigrationError) as err:
+            problems = ["Upgrade failed: %s" % err]
+        finally:
+            baseline.close()
+            db.initialize(previous)
+    problems.extend(migration_sql_problems())
+    for problem in problems:
+        warning(problem)
+    if not problems:
+        info("Database of the first release is upgraded to version %d." % SCHEMA_VERSION)
+    return problems
@@ -0,0 +1,163 @@
+# -*- coding:utf-8 -*-
+"""
+This module is used for index and search comments of bills and transfers.
+
+MySQL keeps a FULLTEXT index WITH PARSER ngram on the comments columns.
+SQLite keeps an FTS5 table per model (rowid is the bill or transfer id)
+maintained by DatabaseDriver; its text is split into single characters and
+character bigrams here, because FTS5 tokenizers keep a run of Chinese
+characters as one word. Every search term is also checked as a substring
+of the comments, on the matched rows only.
+"""
+import re
+import weakref
+from peewee import SQL, Value, JOIN, OperationalError
+from playhouse.mysql_ext import Match
+from playhouse.sqlite_ext import FTS5Model, SearchField
+from utils import warning
+
+from dbmodel import Bill, Transfer
+from app import db, is_sqlite
+
+WORD = re.compile(r'\w+')
+
+# rows indexed at a time when building an index from existing rows
+INDEX_BATCH_SIZE = 1000
+
+class BillSearch(FTS5Model):
+    tokens = SearchField()
+
+    class Meta:
+        database = db
+        table_name = 'bill_search'
+
+class TransferSearch(FTS5Model):
+    tokens = SearchField()
+
+    class Meta:
+        database = db
+        table_name = 'transfer_search'
+
+SEARCH_MODELS = {Bill: BillSearch, Transfer: TransferSearch}
+
+# databases whose search tables were looked up, with the result
+AVAILABLE = weakref.WeakKeyDictionary()
+
+def terms(text):
+    """Words of a search text, lower cased."""
+    return WORD.findall((text or '').lower())
+
+def bigrams(word):
+    if len(word) < 2:
+        return [word]
+    return [word[index:index + 2] for index in range(len(word) - 1)]
+
+def tokens(text):
+    """Text stored in the FTS5 table: every character and every bigram."""
+    items = []
+    for word in terms(text):
+        items.extend(word)
+        if len(word) > 1:
+            items.extend(bigrams(word))
+    return ' '.join(items)
+
+def fts_query(words):
+    return ' AND '.join('"%s"' % token.replace('"', '""')
+                        for word in words for token in bigrams(word))
+
+def boolean_query(words):
+    """MySQL boolean mode query, terms shorter than an ngram are left to LIKE."""
+    return ' '.join('+"%s"' % word.replace('"', '') for word in words if len(word) > 1)
+
+def search_available():
+    """Whether the search tables exist (FTS5 may be missing from SQLite)."""
+    database = db.get_database()
+    if database not in AVAILABLE:
+        AVAILABLE[database] = not is_sqlite() or \
+            BillSearch._meta.table_name in db.get_tables()
+    return AVAILABLE[database]
+
+def create_search_indexes():
+    """Create the search indexes and fill them from existing rows."""
+    if not is_sqlite():
+        existed = set(index.name for model in SEARCH_MODELS
+                      for index in db.get_indexes(model._meta.table_name))
+        for model in SEARCH_MODELS:
+            table = model._meta.table_name
+            name = '%s_comments_fulltext' % table
+            if name in existed:
+                continue
+            db.execute_sql('ALTER TABLE `%s` ADD FULLTEXT INDEX `%s` (`%s`) WITH PARSER ngram' %
+                           (table, name, model.comments.column_name))
+        return
+    AVAILABLE.pop(db.get_database(), None)
+    tables = set(db.get_tables())
+    for model, search_model in SEARCH_MODELS.items():
+        if search_model._meta.table_name in tables:
+            continue
+        try:
+            search_model.create_table()
+        except OperationalError as err:
+            warning("Search index of %s is not created, comments are searched "
+                    "by scanning: %s" % (model._meta.table_name, err))
+            return
+        last_id = 0
+        while True:
+            rows = list(model
+                        .select(model.id, model.comments)
+                        .where(model.id > last_id, model.comments.is_null(False))
+                        .order_by(model.id)
+                        .limit(INDEX_BATCH_SIZE)
+                        .tuples())
+            if not rows:
+                break
+            search_model.insert_many([{'rowid': row_id, 'tokens': tokens(comments)}
+                                      for row_id, comments in rows]).execute()
+            last_id = rows[-1][0]
+
+def index_rows(model, rows):
+    """
+    Add rows just inserted into model (dicts with comments and their id or
+    content_hash) to its search index. Nothing to do on MySQL.
+    """
+    if not is_sqlite() or not search_available():
+        return
+    items = [(row['id'], row['comments']) for row in rows
+             if row['comments'] and 'id' in row]
+    hashes = [row['content_hash'] for row in rows
+              if row['comments'] and 'id' not in row]
+    if hashes:
+        items.extend(model
+                     .select(model.id, model.comments)
+                     .where(model.content_hash.in_(hashes))
+                     .tuples())
+    if not items:
+        return
+    SEARCH_MODELS[model].insert_many([{'rowid': row_id, 'tokens': tokens(comments)}
+                                      for row_id, comments in items]).execute()
+
+def match(query, model, text):
+    """
+    Narrow a query of model to rows whose comments contain every word of
+    text, through the search index.
+    """
+    words = terms(text)
+    if not words:
+        return query.where(SQL('1 = 0'))
+    for word in words:
+        query = query.where(model.comments.contains(word))
+    if not search_available():
+        return query
+    if is_sqlite():
+        # CROSS JOIN keeps the FTS5 table as the outer loop in SQLite, else the
+        # planner walks all bills of the user in date order for the ORDER BY
+        search_model = SEARCH_MODELS[model]
+        return (query
+                .from_(search_model)
+                .join(model, JOIN.CROSS)
+                .where(search_model.rowid==model.id,
+                       search_model.match(fts_query(words))))
+    expression = boolean_query(words)
+    if not expression:
+        return query
+    return query.where(Match(model.comments, Value(expression), 'IN BOOLEAN MODE'))
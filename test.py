@@ -5,63 +5,19 @@ import csv
 
 from dbdriver import DatabaseDriver
 from dbdriver import NotFindItemError
+from importer import Importer
+from dbdriver import STAT_FIELDS
+from money import from_cents
 from dbmodel import User, Bill, Transfer, \
                           Account, AccountGroup, AccountStatMonth
 from app import db
 
 def create_test_bill(driver):
-    try:
-        filename = 'testdata/bills.csv'
-        bills_file = open(filename, 'r')
-        bills_reader = csv.DictReader(bills_file)
-    except Exception():
-        error("CSV file %s read failed." % filename)
-        return
-
-    for bill_item in bills_reader:
-        if driver.get_user().nickname != bill_item['user']:
-            warning("Current bill's user is %s, not you." % bill_item['user'])
-            continue
-
-        try:
-            account = driver.get_account(bill_item['account'])
-        except NotFindItemError as err:
-            warning(err.args[0])
-            warning("Current bill insert failed.")
-            continue
-
-        driver.create_bill(float(bill_item['amount']), bill_item['inout'], account,
-                           bill_item['billing_date'], bill_item['billing_time'],
-                           bill_item['comments'])
-
+    Importer(driver).import_bills('testdata/bills.csv').report()
     info("Test bills are inserted.")
 
 def create_test_transfer(driver):
-    try:
-        filename = 'testdata/transfers.csv'
-        transfer_file = open(filename, 'r')
-        transfer_reader = csv.DictReader(transfer_file)
-    except Exception():
-        error("CSV file %s read failed." % filename)
-        return
-
-    for transfer_item in transfer_reader:
-        if driver.get_user().nickname != transfer_item['user']:
-            warning("Current transfer's user is %s, not you." % transfer_item['user'])
-            continue
-
-        try:
-            from_account = driver.get_account(transfer_item['from_account'])
-            to_account = driver.get_account(transfer_item['to_account'])
-        except NotFindItemError as err:
-            warning(err.args[0])
-            warning("Current transfer insert failed.")
-            continue
-
-        driver.create_transfer(float(transfer_item['amount']), from_account, to_account,
-                               transfer_item['transfer_date'], transfer_item['transfer_time'],
-                               transfer_item['comments'])
-
+    Importer(driver).import_transfers('testdata/transfers.csv').report()
     info("Test transfers are inserted.")
 
 def create_test_account(driver):
@@ -89,7 +45,7 @@ def create_test_account(driver):
             driver.get_account(name=account_item['name'])
         except NotFindItemError:
             driver.create_account(name=account_item['name'],
-                                            is_credit=bool(account_item['is_credit']),
+                                            is_credit=account_item['is_credit'] == 'True',
                                             group_name=account_item['group'],
                                             currency=account_item['currency'])
         else:
@@ -98,26 +54,7 @@ def create_test_account(driver):
     info("Test accounts are created.")
 
 def create_test_month_stat(driver):
-    try:
-        filename = 'testdata/month_stats.csv'
-        stat_file = open(filename, 'r')
-        stat_reader = csv.DictReader(stat_file)
-    except Exception():
-        error("CSV file %s read failed." % filename)
-        return
-
-    for stat in stat_reader:
-        try:
-            driver.get_account(name=stat['account'])
-        except NotFindItemError:
-            warning("Account %s is not existed." % stat['account'])
-            continue
-
-        driver.create_account_stat_month(
-                stat['month'], stat['account'], stat['amount'], stat['adjust'],
-                stat['interest_income'], stat['invest_income'], stat['normal_income'],
-                stat['normal_outcome'], stat['transfer'])
-
+    Importer(driver).import_month_stats('testdata/month_stats.csv').report()
     info("Test month statistics are created.")
 
 def init_database(driver):
@@ -133,31 +70,29 @@ def init_database(driver):
 def check_database(driver):
     # 查看账户
     info("Check all of accounts in the datebase:")
-    accounts = driver.get_all_accounts()
+    accounts = driver.get_account_overview()
     for account in accounts:
-        account_group_name = AccountGroup.get(id=account.account_group_id).account_group_name
-        info("account: %s, is_credit: %s, init_balance: %f, remain_balance: %f, currency: %s, user: %s, group: %s" %
-                (account.account_name, account.is_credit, account.init_balance,
-                 account.remain_balance, account.currency, driver.get_user().nickname,
+        account_group_name = account.account_group_id.account_group_name
+        info("account: %s, is_credit: %s, init_balance: %s, remain_balance: %s, currency: %s, user: %s, group: %s" %
+                (account.account_name, account.is_credit, from_cents(account.init_balance),
+                 from_cents(account.remain_balance), account.currency, driver.get_user().nickname,
                  account_group_name))
 
         # 同时查看账户内的账单信息
         info("Check all of bills in the account %s" % account.account_name)
-        bills = driver.get_all_bills(account)
+        bills = account.bills
         for bill in bills:
-            info("amount: %f, inout_type: %s, billing_date: %s, billing_time: %s, comments: %s" %
-                    (bill.amount, bill.inout_type, bill.billing_date,
+            info("amount: %s, inout_type: %s, billing_date: %s, billing_time: %s, comments: %s" %
+                    (from_cents(bill.amount), bill.inout_type, bill.billing_date,
                         bill.billing_time, bill.comments))
 
         # 同时查看账户的月统计信息
         info("Check all of month statistics of the account %s" % account.account_name)
-        stat_months = driver.get_all_stat_months(account)
+        stat_months = account.AccountStatMonths
         for stat_month in stat_months:
-            info("date: %s, amount: %f, adjust: %f, interest_income: %f, invest_income: %f, normal_income: %f, normal_outcome: %f, transfer: %f]" %
-                    (stat_month.date, stat_month.amount,
-                        stat_month.adjust, stat_month.interest_income,
-                        stat_month.invest_income, stat_month.normal_income,
-                        stat_month.normal_outcome, stat_month.transfer))
+            info("date: %s, amount: %s, adjust: %s, interest_income: %s, invest_income: %s, normal_income: %s, normal_outcome: %s, transfer: %s]" %
+                    ((stat_month.date,) + tuple(from_cents(getattr(stat_month, field))
+                                                for field in STAT_FIELDS)))
         info("Next account")
 
 if __name__ == "__main__":